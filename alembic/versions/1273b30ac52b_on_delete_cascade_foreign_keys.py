@@ -0,0 +1,89 @@
+"""on delete cascade foreign keys
+
+Revision ID: 1273b30ac52b
+Revises: 45dbc225edce
+Create Date: 2026-10-18 21:12:45.730218
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision = '1273b30ac52b'
+down_revision = '45dbc225edce'
+branch_labels = None
+depends_on = None
+
+
+# (table, column, referred table)
+FOREIGN_KEYS = [
+    ('recommendation', 'user_id', 'user'),
+    ('recommendationtaglink', 'recommendation_id', 'recommendation'),
+    ('relatedrecommendation', 'recommendation_id', 'recommendation'),
+    ('relatedrecommendation', 'related_id', 'recommendation'),
+]
+
+# Recreating the recommendation table in batch mode drops its triggers.
+SQLITE_TRIGGERS = """
+CREATE TRIGGER recommendation_fts_insert AFTER INSERT ON recommendation BEGIN
+    INSERT INTO recommendation_fts (rowid, title, short_description, opinion)
+    VALUES (new.id, new.title, new.short_description, new.opinion);
+END;
+CREATE TRIGGER recommendation_fts_delete AFTER DELETE ON recommendation BEGIN
+    INSERT INTO recommendation_fts (recommendation_fts, rowid, title, short_description, opinion)
+    VALUES ('delete', old.id, old.title, old.short_description, old.opinion);
+END;
+CREATE TRIGGER recommendation_fts_update AFTER UPDATE ON recommendation BEGIN
+    INSERT INTO recommendation_fts (recommendation_fts, rowid, title, short_description, opinion)
+    VALUES ('delete', old.id, old.title, old.short_description, old.opinion);
+    INSERT INTO recommendation_fts (rowid, title, short_description, opinion)
+    VALUES (new.id, new.title, new.short_description, new.opinion);
+END;
+"""
+
+
+def replace_foreign_keys(ondelete: str | None) -> None:
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        # NOT VALID skips the check of existing rows while ALTER TABLE
+        # holds its ACCESS EXCLUSIVE lock. Locks last until the transaction
+        # ends, so VALIDATE, which lets writes through, runs after the
+        # migration transaction committed. A failed VALIDATE leaves the
+        # constraint NOT VALID, it can simply be run again.
+        action = f' ON DELETE {ondelete}' if ondelete else ''
+        for table, column, referred_table in FOREIGN_KEYS:
+            name = f'{table}_{column}_fkey'
+            op.execute(f'ALTER TABLE "{table}" DROP CONSTRAINT {name}, '
+                       f'ADD CONSTRAINT {name} FOREIGN KEY ({column}) '
+                       f'REFERENCES "{referred_table}" (id){action} NOT VALID')
+        with op.get_context().autocommit_block():
+            for table, column, _ in FOREIGN_KEYS:
+                op.execute(f'ALTER TABLE "{table}" VALIDATE CONSTRAINT {table}_{column}_fkey')
+        return
+
+    # The constraints were created unnamed, name them so batch mode can
+    # drop them.
+    naming_convention = {'fk': 'fk_%(table_name)s_%(column_0_name)s_%(referred_table_name)s'}
+    tables = dict.fromkeys(table for table, _, _ in FOREIGN_KEYS)
+    for table in tables:
+        with op.batch_alter_table(table, naming_convention=naming_convention) as batch_op:
+            for fk_table, column, referred_table in FOREIGN_KEYS:
+                if fk_table != table:
+                    continue
+                name = f'fk_{table}_{column}_{referred_table}'
+                batch_op.drop_constraint(name, type_='foreignkey')
+                batch_op.create_foreign_key(name, referred_table, [column], ['id'],
+                                            ondelete=ondelete)
+    if bind.dialect.name == 'sqlite':
+        for statement in SQLITE_TRIGGERS.split('END;')[:-1]:
+            op.execute(statement + 'END;')
+
+
+def upgrade() -> None:
+    replace_foreign_keys('CASCADE')
+
+
+def downgrade() -> None:
+    replace_foreign_keys(None)
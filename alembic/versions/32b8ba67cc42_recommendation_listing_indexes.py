@@ -0,0 +1,91 @@
+"""recommendation listing indexes
+
+Revision ID: 32b8ba67cc42
+Revises: bfd657f2ab68
+Create Date: 2026-10-18 17:21:40.902115
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision = '32b8ba67cc42'
+down_revision = 'bfd657f2ab68'
+branch_labels = None
+depends_on = None
+
+
+# (name, columns)
+INDEXES = [
+    ('ix_recommendation_published_id', ['published', 'id']),
+    ('ix_recommendation_user_id_published_id', ['user_id', 'published', 'id']),
+    ('ix_recommendation_type_of_fiction_published_id', ['type_of_fiction', 'published', 'id']),
+]
+
+
+def upgrade() -> None:
+    # Listings are keyset-paginated on (published, id), rows published
+    # before the column existed get the oldest possible position.
+    op.execute("UPDATE recommendation SET published = '1970-01-01 00:00:00' "
+               "WHERE published IS NULL")
+    bind = op.get_bind()
+    if bind.dialect.name == 'sqlite':
+        # The constraint was created unnamed, name it so batch mode can drop it.
+        with op.batch_alter_table(
+                'recommendation',
+                naming_convention={'uq': 'uq_%(table_name)s_%(column_0_name)s'}
+        ) as batch_op:
+            batch_op.drop_constraint('uq_recommendation_type_of_fiction',
+                                     type_='unique')
+            batch_op.alter_column('published', existing_type=sa.DateTime(),
+                                  nullable=False)
+        for name, columns in INDEXES:
+            op.create_index(name, 'recommendation', columns, unique=False)
+        return
+
+    # Never declared on the model, it only allowed a single
+    # recommendation per type of fiction.
+    op.drop_constraint('recommendation_type_of_fiction_key',
+                       'recommendation', type_='unique')
+    # SET NOT NULL scans the table under an ACCESS EXCLUSIVE lock unless a
+    # validated CHECK constraint already proves it. The check is added NOT
+    # VALID and validated after the commit, with a lock that lets writes
+    # through; it is dropped again once the column is NOT NULL.
+    op.execute('ALTER TABLE recommendation ADD CONSTRAINT recommendation_published_not_null '
+               'CHECK (published IS NOT NULL) NOT VALID')
+    with op.get_context().autocommit_block():
+        op.execute('ALTER TABLE recommendation '
+                   'VALIDATE CONSTRAINT recommendation_published_not_null')
+    op.alter_column('recommendation', 'published',
+                    existing_type=sa.DateTime(), nullable=False)
+    op.drop_constraint('recommendation_published_not_null', 'recommendation', type_='check')
+    # CONCURRENTLY does not block writes while the indexes are built but
+    # can not run inside a transaction. A failed build leaves an INVALID
+    # index behind that has to be dropped before a retry.
+    with op.get_context().autocommit_block():
+        for name, columns in INDEXES:
+            op.create_index(name, 'recommendation', columns, unique=False,
+                            postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    # The unique constraint on type_of_fiction dropped by upgrade() is not
+    # restored: once two recommendations share a type of fiction it can not
+    # be created again, and the application never relied on it. Restoring
+    # the old schema exactly needs duplicates removed and
+    # ALTER TABLE recommendation ADD CONSTRAINT recommendation_type_of_fiction_key
+    # UNIQUE (type_of_fiction) run by hand.
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            for name, _ in reversed(INDEXES):
+                op.drop_index(name, table_name='recommendation',
+                              postgresql_concurrently=True)
+    else:
+        for name, _ in reversed(INDEXES):
+            op.drop_index(name, table_name='recommendation')
+    with op.batch_alter_table('recommendation') as batch_op:
+        batch_op.alter_column('published', existing_type=sa.DateTime(),
+                              nullable=True)
@@ -0,0 +1,42 @@
+"""related recommendations
+
+Revision ID: 45dbc225edce
+Revises: d9f8877919a7
+Create Date: 2026-10-18 20:04:37.560921
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision = '45dbc225edce'
+down_revision = 'd9f8877919a7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Filled by python -m app.commands.rebuild_related.
+    op.create_table('relatedrecommendation',
+    sa.Column('recommendation_id', sa.Integer(), nullable=False),
+    sa.Column('related_id', sa.Integer(), nullable=False),
+    sa.Column('score', sa.Float(), nullable=False),
+    sa.ForeignKeyConstraint(['recommendation_id'], ['recommendation.id'], ),
+    sa.ForeignKeyConstraint(['related_id'], ['recommendation.id'], ),
+    sa.PrimaryKeyConstraint('recommendation_id', 'related_id')
+    )
+    op.create_index('ix_relatedrecommendation_recommendation_id_score_related_id',
+                    'relatedrecommendation', ['recommendation_id', 'score', 'related_id'],
+                    unique=False)
+    op.create_index('ix_relatedrecommendation_related_id',
+                    'relatedrecommendation', ['related_id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_relatedrecommendation_related_id',
+                  table_name='relatedrecommendation')
+    op.drop_index('ix_relatedrecommendation_recommendation_id_score_related_id',
+                  table_name='relatedrecommendation')
+    op.drop_table('relatedrecommendation')
@@ -0,0 +1,76 @@
+"""recommendation full text search
+
+Revision ID: 494e2b341c75
+Revises: 32b8ba67cc42
+Create Date: 2026-10-18 17:40:03.551270
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision = '494e2b341c75'
+down_revision = '32b8ba67cc42'
+branch_labels = None
+depends_on = None
+
+
+SQLITE_TRIGGERS = """
+CREATE TRIGGER recommendation_fts_insert AFTER INSERT ON recommendation BEGIN
+    INSERT INTO recommendation_fts (rowid, title, short_description, opinion)
+    VALUES (new.id, new.title, new.short_description, new.opinion);
+END;
+CREATE TRIGGER recommendation_fts_delete AFTER DELETE ON recommendation BEGIN
+    INSERT INTO recommendation_fts (recommendation_fts, rowid, title, short_description, opinion)
+    VALUES ('delete', old.id, old.title, old.short_description, old.opinion);
+END;
+CREATE TRIGGER recommendation_fts_update AFTER UPDATE ON recommendation BEGIN
+    INSERT INTO recommendation_fts (recommendation_fts, rowid, title, short_description, opinion)
+    VALUES ('delete', old.id, old.title, old.short_description, old.opinion);
+    INSERT INTO recommendation_fts (rowid, title, short_description, opinion)
+    VALUES (new.id, new.title, new.short_description, new.opinion);
+END;
+"""
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        # Weights A/B/C rank title matches above description and opinion.
+        op.execute("""
+            ALTER TABLE recommendation ADD COLUMN search_vector tsvector
+            GENERATED ALWAYS AS (
+                setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+                setweight(to_tsvector('english', coalesce(short_description, '')), 'B') ||
+                setweight(to_tsvector('english', coalesce(opinion, '')), 'C')
+            ) STORED
+        """)
+        op.create_index('ix_recommendation_search_vector', 'recommendation',
+                        ['search_vector'], unique=False, postgresql_using='gin')
+    elif bind.dialect.name == 'sqlite':
+        # External content FTS5 index kept in sync by triggers, the porter
+        # tokenizer stems words like the english text search configuration.
+        op.execute("""
+            CREATE VIRTUAL TABLE recommendation_fts USING fts5(
+                title, short_description, opinion,
+                content='recommendation', content_rowid='id',
+                tokenize='porter unicode61'
+            )
+        """)
+        for statement in SQLITE_TRIGGERS.split('END;')[:-1]:
+            op.execute(statement + 'END;')
+        op.execute("INSERT INTO recommendation_fts (recommendation_fts) VALUES ('rebuild')")
+
+
+def downgrade() -> None:
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        op.drop_index('ix_recommendation_search_vector', table_name='recommendation')
+        op.drop_column('recommendation', 'search_vector')
+    elif bind.dialect.name == 'sqlite':
+        op.execute("DROP TRIGGER recommendation_fts_update")
+        op.execute("DROP TRIGGER recommendation_fts_delete")
+        op.execute("DROP TRIGGER recommendation_fts_insert")
+        op.execute("DROP TABLE recommendation_fts")
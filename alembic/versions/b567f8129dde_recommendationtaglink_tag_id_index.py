@@ -0,0 +1,49 @@
+"""recommendationtaglink tag_id index
+
+Revision ID: b567f8129dde
+Revises: 494e2b341c75
+Create Date: 2026-10-18 19:02:11.408213
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision = 'b567f8129dde'
+down_revision = '494e2b341c75'
+branch_labels = None
+depends_on = None
+
+
+# The primary key starts with recommendation_id, lookups by tag (tag
+# filters, tag deletes) need their own index. recommendation.user_id is
+# covered by ix_recommendation_user_id_published_id and tag.name by
+# ix_tag_name.
+def upgrade() -> None:
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        # CONCURRENTLY does not block writes while the index is built but
+        # can not run inside a transaction. A failed build leaves an
+        # INVALID index behind that has to be dropped before a retry.
+        with op.get_context().autocommit_block():
+            op.create_index('ix_recommendationtaglink_tag_id_recommendation_id',
+                            'recommendationtaglink', ['tag_id', 'recommendation_id'],
+                            unique=False, postgresql_concurrently=True)
+    else:
+        op.create_index('ix_recommendationtaglink_tag_id_recommendation_id',
+                        'recommendationtaglink', ['tag_id', 'recommendation_id'],
+                        unique=False)
+
+
+def downgrade() -> None:
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            op.drop_index('ix_recommendationtaglink_tag_id_recommendation_id',
+                          table_name='recommendationtaglink',
+                          postgresql_concurrently=True)
+    else:
+        op.drop_index('ix_recommendationtaglink_tag_id_recommendation_id',
+                      table_name='recommendationtaglink')
@@ -0,0 +1,68 @@
+"""unique index on tag name
+
+Revision ID: bfd657f2ab68
+Revises: c9d440471e0e
+Create Date: 2026-10-18 17:05:12.418391
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision = 'bfd657f2ab68'
+down_revision = 'c9d440471e0e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Tags could be inserted twice by concurrent requests, merge duplicates
+    # into the tag with the lowest id before the index is created.
+    op.execute("""
+        INSERT INTO recommendationtaglink (recommendation_id, tag_id)
+        SELECT DISTINCT link.recommendation_id, keeper.keeper_id
+        FROM recommendationtaglink AS link
+        JOIN (
+            SELECT tag.id AS tag_id,
+                   (SELECT MIN(other.id) FROM tag AS other
+                    WHERE other.name = tag.name) AS keeper_id
+            FROM tag
+        ) AS keeper ON keeper.tag_id = link.tag_id
+        WHERE keeper.tag_id != keeper.keeper_id
+        AND NOT EXISTS (
+            SELECT 1 FROM recommendationtaglink AS existing
+            WHERE existing.recommendation_id = link.recommendation_id
+            AND existing.tag_id = keeper.keeper_id
+        )
+    """)
+    op.execute("""
+        DELETE FROM recommendationtaglink
+        WHERE tag_id NOT IN (SELECT MIN(id) FROM tag GROUP BY name)
+    """)
+    op.execute("""
+        DELETE FROM tag
+        WHERE id NOT IN (SELECT MIN(id) FROM tag GROUP BY name)
+    """)
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        # CONCURRENTLY does not block writes while the index is built but
+        # can not run inside a transaction. A name inserted twice between
+        # the cleanup above and the build fails it and leaves an INVALID
+        # index behind, drop it and run the migration again.
+        with op.get_context().autocommit_block():
+            op.create_index(op.f('ix_tag_name'), 'tag', ['name'], unique=True,
+                            postgresql_concurrently=True)
+    else:
+        op.create_index(op.f('ix_tag_name'), 'tag', ['name'], unique=True)
+
+
+def downgrade() -> None:
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            op.drop_index(op.f('ix_tag_name'), table_name='tag',
+                          postgresql_concurrently=True)
+    else:
+        op.drop_index(op.f('ix_tag_name'), table_name='tag')
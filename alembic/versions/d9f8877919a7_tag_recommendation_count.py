@@ -0,0 +1,33 @@
+"""tag recommendation count
+
+Revision ID: d9f8877919a7
+Revises: b567f8129dde
+Create Date: 2026-10-18 19:31:52.118604
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision = 'd9f8877919a7'
+down_revision = 'b567f8129dde'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('tag', sa.Column('recommendation_count', sa.Integer(),
+                                   server_default='0', nullable=False))
+    op.execute("UPDATE tag SET recommendation_count = ("
+               "SELECT count(*) FROM recommendationtaglink "
+               "WHERE recommendationtaglink.tag_id = tag.id)")
+    op.create_index('ix_tag_recommendation_count_id', 'tag',
+                    ['recommendation_count', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_tag_recommendation_count_id', table_name='tag')
+    with op.batch_alter_table('tag') as batch_op:
+        batch_op.drop_column('recommendation_count')
@@ -0,0 +1,51 @@
+"""facet counts
+
+Revision ID: db9451d7862c
+Revises: 1273b30ac52b
+Create Date: 2026-10-18 23:05:12.418377
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision = 'db9451d7862c'
+down_revision = '1273b30ac52b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('typeoffictioncount',
+    sa.Column('type_of_fiction', sqlmodel.sql.sqltypes.AutoString(length=255), nullable=False),
+    sa.Column('recommendation_count', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('type_of_fiction')
+    )
+    op.create_table('tagtypeoffictioncount',
+    sa.Column('tag_id', sa.Integer(), nullable=False),
+    sa.Column('type_of_fiction', sqlmodel.sql.sqltypes.AutoString(length=255), nullable=False),
+    sa.Column('recommendation_count', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['tag_id'], ['tag.id'], ),
+    sa.PrimaryKeyConstraint('tag_id', 'type_of_fiction')
+    )
+    op.create_index('ix_tagtypeoffictioncount_type_of_fiction_count',
+                    'tagtypeoffictioncount',
+                    ['type_of_fiction', 'recommendation_count', 'tag_id'], unique=False)
+    op.execute("INSERT INTO typeoffictioncount (type_of_fiction, recommendation_count) "
+               "SELECT type_of_fiction, count(*) FROM recommendation "
+               "GROUP BY type_of_fiction")
+    op.execute("INSERT INTO tagtypeoffictioncount "
+               "(tag_id, type_of_fiction, recommendation_count) "
+               "SELECT recommendationtaglink.tag_id, recommendation.type_of_fiction, count(*) "
+               "FROM recommendationtaglink JOIN recommendation "
+               "ON recommendation.id = recommendationtaglink.recommendation_id "
+               "GROUP BY recommendationtaglink.tag_id, recommendation.type_of_fiction")
+
+
+def downgrade() -> None:
+    op.drop_index('ix_tagtypeoffictioncount_type_of_fiction_count',
+                  table_name='tagtypeoffictioncount')
+    op.drop_table('tagtypeoffictioncount')
+    op.drop_table('typeoffictioncount')
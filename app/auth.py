@@ -1,3 +1,4 @@
+import time
 from datetime import datetime, timedelta
 from typing import Annotated
 
@@ -5,18 +6,23 @@ from decouple import config
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 from pydantic import BaseModel
-from sqlmodel import Session
+from sqlalchemy.orm import make_transient_to_detached
+from sqlmodel.ext.asyncio.session import AsyncSession
 
+from .cache import LRUCache
 from .database import get_session
 from .crud import get_user_with_username
+from .hashing import hash_password, verify_and_update_password
+from .metrics import JWT_DECODE_DURATION
 from .models import User
 
 
 SECRET_KEY = config("SECRET_KEY")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRES_HOURS = 5
+PRINCIPAL_CACHE_SIZE = config("PRINCIPAL_CACHE_SIZE", default=4096, cast=int)
+PRINCIPAL_CACHE_TTL = config("PRINCIPAL_CACHE_TTL", default=60, cast=float)
 
 
 class Token(BaseModel):
@@ -28,26 +34,57 @@ class TokenData(BaseModel):
     username: str | None = None
 
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl='auth/token')
 
+# token -> username of tokens that were already decoded, kept no longer
+# than the token itself is valid.
+token_cache = LRUCache(max_size=PRINCIPAL_CACHE_SIZE)
+# username -> column values of the user row.
+user_cache = LRUCache(max_size=PRINCIPAL_CACHE_SIZE, ttl=PRINCIPAL_CACHE_TTL)
+
+
+def cache_user(user: User):
+    user_cache.set(user.username, user.dict())
+
+
+def invalidate_user(username: str):
+    user_cache.delete(username)
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
 
+def _user_from_cache(username: str) -> User | None:
+    values = user_cache.get(username)
+    if values is None:
+        return None
+    # Every request gets its own instance, marked as already persisted so
+    # that it can be added to a session and updated without a SELECT.
+    user = User(**values)
+    make_transient_to_detached(user)
+    return user
+
+
+async def get_password_hash(password):
+    return await hash_password(password)
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
 
+async def verify_password(plain_password, hashed_password):
+    valid, _ = await verify_and_update_password(plain_password, hashed_password)
+    return valid
 
-def authenticate_user(*, session: Session,
-                      username: str, password: str):
-    user = get_user_with_username(session=session, username=username)
+
+async def authenticate_user(*, session: AsyncSession,
+                            username: str, password: str):
+    user = await get_user_with_username(session=session, username=username)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    valid, new_hash = await verify_and_update_password(password,
+                                                       user.hashed_password)
+    if not valid:
         return False
+    if new_hash:
+        user.hashed_password = new_hash
+        session.add(user)
+        await session.commit()
+        invalidate_user(user.username)
     return user
 
 
@@ -62,23 +99,31 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
     return encoded_jwt
 
 
-def get_current_user(token: Annotated[str, Depends(oauth2_scheme)],
-                     session: Annotated[Session, Depends(get_session)]):
+async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)],
+                           session: Annotated[AsyncSession, Depends(get_session)]):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"}
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
+    username: str | None = token_cache.get(token)
+    if username is None:
+        try:
+            with JWT_DECODE_DURATION.time():
+                payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            username = payload.get("sub")
+            if username is None:
+                raise credentials_exception
+        except JWTError:
             raise credentials_exception
-        token_data = TokenData(username=username)
-    except JWTError:
-        raise credentials_exception
-    user = get_user_with_username(session=session,
-                                  username=token_data.username)
+        token_cache.set(token, username, ttl=payload["exp"] - time.time())
+    token_data = TokenData(username=username)
+    user = _user_from_cache(token_data.username)
+    if user is not None:
+        return user
+    user = await get_user_with_username(session=session,
+                                        username=token_data.username)
     if user is None:
         raise credentials_exception
+    cache_user(user)
     return user
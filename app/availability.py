@@ -0,0 +1,162 @@
+import asyncio
+import hashlib
+import math
+import time
+
+from decouple import config
+from sqlalchemy import func
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from .crud import get_user_with_username, get_user_with_email
+from .database import async_session
+from .models import User
+
+
+# The filters are sized for this many users, or twice the users at startup
+# when there are more, and answer "maybe taken" for about this share of
+# free values.
+AVAILABILITY_FILTER_CAPACITY = config("AVAILABILITY_FILTER_CAPACITY", default=1000000, cast=int)
+AVAILABILITY_FILTER_ERROR_RATE = config("AVAILABILITY_FILTER_ERROR_RATE",
+                                        default=0.01, cast=float)
+# Users registered through other workers are added at most REFRESH seconds
+# late, renames and ids that committed out of order with the complete
+# reload, at most RELOAD seconds late.
+AVAILABILITY_REFRESH_SECONDS = config("AVAILABILITY_REFRESH_SECONDS", default=5, cast=float)
+AVAILABILITY_RELOAD_SECONDS = config("AVAILABILITY_RELOAD_SECONDS", default=300, cast=float)
+AVAILABILITY_LOAD_BATCH_SIZE = 10000
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float):
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value: str):
+        # Double hashing, k positions out of one 128 bit digest.
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, value: str):
+        for position in self._positions(value):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(value))
+
+
+class TakenNames:
+    # Usernames and emails in use. A value the filter has never seen is
+    # free without asking the database, any other is looked up. New ids
+    # are read every AVAILABILITY_REFRESH_SECONDS, renames done by other
+    # workers and ids that committed out of order only with the complete
+    # reload every AVAILABILITY_RELOAD_SECONDS, so an answer can be stale
+    # for that long; the unique indexes still decide on register.
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.usernames: BloomFilter | None = None
+        self.emails: BloomFilter | None = None
+        self.last_id = 0
+        self.refreshed_at = 0.0
+        self.reloaded_at = 0.0
+        self.reloads = 0
+        self.filter_answers = 0
+        self.database_answers = 0
+        self._lock = asyncio.Lock()
+        self._added: list[tuple[str, str]] | None = None
+
+    def add(self, username: str, email: str):
+        if self._added is not None:
+            self._added.append((username, email))
+        if self.usernames is not None:
+            self.usernames.add(username)
+            self.emails.add(email)
+
+    async def _load_users(self, session: AsyncSession, after_id: int,
+                          usernames: BloomFilter, emails: BloomFilter) -> int:
+        last_id = after_id
+        statement = select(User.id, User.username, User.email).\
+            where(User.id > after_id).order_by(User.id).\
+            execution_options(yield_per=AVAILABILITY_LOAD_BATCH_SIZE)
+        result = await session.stream(statement)
+        async for user_id, username, email in result:
+            usernames.add(username)
+            emails.add(email)
+            last_id = max(last_id, user_id)
+        return last_id
+
+    async def load(self, session: AsyncSession):
+        # New filters are filled while the current ones keep answering.
+        # Values added meanwhile may be missing from the rows read, they
+        # are added to the new filters again.
+        result = await session.execute(select(func.max(User.id)))
+        capacity = max(self.capacity, 2 * (result.scalar() or 0))
+        usernames = BloomFilter(capacity, self.error_rate)
+        emails = BloomFilter(capacity, self.error_rate)
+        self._added = []
+        try:
+            last_id = await self._load_users(session, 0, usernames, emails)
+            for username, email in self._added:
+                usernames.add(username)
+                emails.add(email)
+        finally:
+            self._added = None
+        self.usernames, self.emails, self.last_id = usernames, emails, last_id
+        self.refreshed_at = self.reloaded_at = time.monotonic()
+        self.reloads += 1
+
+    async def _refresh(self, session: AsyncSession):
+        if time.monotonic() - self.refreshed_at < AVAILABILITY_REFRESH_SECONDS:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            if now - self.reloaded_at >= AVAILABILITY_RELOAD_SECONDS:
+                await self.load(session)
+            elif now - self.refreshed_at >= AVAILABILITY_REFRESH_SECONDS:
+                self.last_id = await self._load_users(session, self.last_id,
+                                                      self.usernames, self.emails)
+                self.refreshed_at = time.monotonic()
+
+    async def username_taken(self, session: AsyncSession, username: str) -> bool:
+        if self.usernames is not None:
+            await self._refresh(session)
+            if username not in self.usernames:
+                self.filter_answers += 1
+                return False
+        self.database_answers += 1
+        return await get_user_with_username(session=session, username=username) is not None
+
+    async def email_taken(self, session: AsyncSession, email: str) -> bool:
+        if self.emails is not None:
+            await self._refresh(session)
+            if email not in self.emails:
+                self.filter_answers += 1
+                return False
+        self.database_answers += 1
+        return await get_user_with_email(session=session, email=email) is not None
+
+    def stats(self) -> dict:
+        if self.usernames is None:
+            return {"loaded": False, "database_answers": self.database_answers}
+        return {"loaded": True,
+                "entries": self.usernames.count,
+                "size_bits": self.usernames.size,
+                "hashes": self.usernames.hashes,
+                "reloads": self.reloads,
+                "filter_answers": self.filter_answers,
+                "database_answers": self.database_answers}
+
+
+taken_names = TakenNames(AVAILABILITY_FILTER_CAPACITY, AVAILABILITY_FILTER_ERROR_RATE)
+
+
+async def load_taken_names():
+    async with async_session() as session:
+        await taken_names.load(session)
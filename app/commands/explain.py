@@ -0,0 +1,238 @@
+"""Check the query plans of the statements the API runs.
+
+    python -m app.commands.seed --recommendations 1000000 --links 3000000
+    python -m app.commands.explain --min-rows 100000
+
+Every access path of crud.py and the routers is executed once inside a
+transaction that is rolled back, the statements are captured and run again
+with EXPLAIN. The command fails (exit code 1) when a plan reads a whole
+table with at least --min-rows rows, so run it against a seeded database.
+"""
+import argparse
+import asyncio
+import json
+import re
+import sys
+
+from sqlalchemy import event, func, select
+
+from ..crud import (get_user_with_username, get_user_with_email, resolve_tag_ids,
+                    get_tag_id, get_recommendation_by_id, get_recommendations_by_ids,
+                    list_recommendations, search_recommendations,
+                    iter_user_recommendations, insert_recommendations,
+                    get_tag_with_name, get_popular_tags, update_recommendation_counts,
+                    delete_user_recommendations, get_type_of_fiction_counts,
+                    get_tag_counts)
+from ..database import async_engine, async_session
+from ..related import get_related_recommendations, update_related,\
+    RELATED_MAX_TAG_RECOMMENDATIONS
+from ..models import User, Tag, Recommendation, RecommendationTagLink, RelatedRecommendation,\
+    TagTypeOfFictionCount
+from ..schemas import RecommendationCreate
+
+
+TABLES = [User, Tag, Recommendation, RecommendationTagLink, RelatedRecommendation,
+          TagTypeOfFictionCount]
+# SQLite reports a full table read as "SCAN table" and a full read of an
+# index as "SCAN table USING COVERING INDEX". "SCAN table USING INDEX"
+# walks an index in order and stops at the LIMIT, as listings do.
+SQLITE_FULL_SCAN = re.compile(r"^SCAN (\w+)(?: AS \w+)?(?:$| USING COVERING INDEX)")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--min-rows", type=int, default=10000,
+                        help="tables with fewer rows may be scanned")
+    parser.add_argument("--verbose", action="store_true", help="print every plan")
+    return parser.parse_args(argv)
+
+
+async def sample(session) -> dict:
+    # Values that exist in the database, the most used tag and the user
+    # with the most recommendations are the worst cases.
+    user_id, = (await session.execute(
+        select(Recommendation.user_id).group_by(Recommendation.user_id).
+        order_by(func.count().desc()).limit(1)
+    )).one()
+    tag_id, = (await session.execute(
+        select(RecommendationTagLink.tag_id).group_by(RecommendationTagLink.tag_id).
+        order_by(func.count().desc()).limit(1)
+    )).one()
+    user = await session.get(User, user_id)
+    tag = await session.get(Tag, tag_id)
+    # update_related leaves out tags above the cap, the most used tag
+    # below it makes it run its candidate query.
+    related_tag = (await session.execute(
+        select(Tag).where(Tag.recommendation_count <= RELATED_MAX_TAG_RECOMMENDATIONS).
+        order_by(Tag.recommendation_count.desc()).limit(1)
+    )).scalar_one_or_none() or tag
+    recommendation = (await session.execute(
+        select(Recommendation).where(Recommendation.user_id == user_id).limit(1)
+    )).scalar_one()
+    return {"user": user, "tag": tag, "related_tag": related_tag,
+            "recommendation": recommendation}
+
+
+async def access_paths(session, values: dict):
+    user, tag, recommendation = values["user"], values["tag"], values["recommendation"]
+    cursor = (recommendation.published, recommendation.id)
+    return [
+        ("get_user_with_username", get_user_with_username(session, user.username)),
+        ("get_user_with_email", get_user_with_email(session, user.email)),
+        ("get_user", session.get(User, user.id)),
+        ("resolve_tag_ids", resolve_tag_ids(session, [tag.name, "explain-missing-tag"])),
+        ("get_tag_id", get_tag_id(session, tag.name)),
+        ("get_tag_with_name", get_tag_with_name(session, tag.name)),
+        ("get_popular_tags", get_popular_tags(session, limit=100)),
+        ("get_type_of_fiction_counts", get_type_of_fiction_counts(session, limit=20)),
+        ("get_type_of_fiction_counts tag",
+         get_type_of_fiction_counts(session, limit=20, tag_id=tag.id)),
+        ("get_tag_counts", get_tag_counts(session, limit=20)),
+        ("get_tag_counts type_of_fiction",
+         get_tag_counts(session, limit=20, type_of_fiction=recommendation.type_of_fiction)),
+        ("get_recommendation_by_id", get_recommendation_by_id(session, recommendation.id)),
+        ("get_recommendations_by_ids",
+         get_recommendations_by_ids(session, [recommendation.id, recommendation.id + 1])),
+        ("list_recommendations", list_recommendations(session, limit=20)),
+        ("list_recommendations cursor", list_recommendations(session, limit=20, after=cursor)),
+        ("list_recommendations user",
+         list_recommendations(session, limit=20, user_id=user.id, after=cursor)),
+        ("list_recommendations tag", list_recommendations(session, limit=20, tag_id=tag.id)),
+        ("list_recommendations type_of_fiction",
+         list_recommendations(session, limit=20,
+                              type_of_fiction=recommendation.type_of_fiction)),
+        ("search_recommendations",
+         search_recommendations(session, recommendation.title, limit=20)),
+        ("iter_user_recommendations", first_export_batch(session, user.id)),
+        ("insert_recommendations",
+         insert_recommendation(session, user.id, [tag, values["related_tag"]])),
+        ("get_related_recommendations",
+         get_related_recommendations(session, recommendation.id)),
+        ("delete_recommendation", delete_recommendation(session, recommendation.id)),
+        ("delete_user_recommendations",
+         delete_user_recommendations(session, user.id, limit=1000)),
+    ]
+
+
+async def first_export_batch(session, user_id: int):
+    batches = iter_user_recommendations(session, user_id)
+    try:
+        return await anext(batches)
+    finally:
+        await batches.aclose()
+
+
+async def insert_recommendation(session, user_id: int, tags: list):
+    ids = await insert_recommendations(
+        session, user_id,
+        [RecommendationCreate(type_of_fiction="fantasy", title="explain",
+                              short_description="explain", opinion="explain",
+                              tags=[tag.name for tag in tags])],
+        {tag.name: tag.id for tag in tags})
+    await update_related(session, ids)
+
+
+async def delete_recommendation(session, recommendation_id: int):
+    recommendation = await get_recommendation_by_id(session, recommendation_id)
+    await update_recommendation_counts(session, recommendation.type_of_fiction,
+                                       [tag.id for tag in recommendation.tags], -1)
+    await session.delete(recommendation)
+    await session.flush()
+
+
+def full_scans_postgresql(plan: dict, tables: set[str]) -> list[str]:
+    scans = []
+    if plan.get("Node Type") == "Seq Scan" and plan.get("Relation Name") in tables:
+        scans.append(plan["Relation Name"])
+    for child in plan.get("Plans", []):
+        scans.extend(full_scans_postgresql(child, tables))
+    return scans
+
+
+async def explain(connection, dialect: str, statement: str, parameters,
+                  tables: set[str]) -> tuple[list[str], list[str]]:
+    if dialect == "postgresql":
+        result = await connection.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {statement}",
+                                                  parameters)
+        plan = result.scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return full_scans_postgresql(plan[0]["Plan"], tables), \
+            [json.dumps(plan[0]["Plan"], indent=2)]
+    if dialect == "sqlite":
+        result = await connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}",
+                                                  parameters)
+        details = [row[-1] for row in result]
+        scans = [match.group(1) for match in map(SQLITE_FULL_SCAN.match, details)
+                 if match and match.group(1) in tables]
+        return scans, details
+    raise NotImplementedError(f"EXPLAIN is not implemented for {dialect}")
+
+
+async def check(args) -> int:
+    async with async_session() as session:
+        connection = await session.connection()
+        dialect = connection.dialect.name
+        tables = set()
+        for model in TABLES:
+            count = (await session.execute(select(func.count()).select_from(model))).scalar()
+            if count >= args.min_rows:
+                tables.add(model.__table__.name)
+        if not tables:
+            print(f"No table has {args.min_rows} rows, seed the database first")
+            return 1
+        if dialect == "postgresql":
+            await connection.exec_driver_sql("ANALYZE")
+
+        values = await sample(session)
+        paths = await access_paths(session, values)
+        captured = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            if executemany:
+                parameters = parameters[0]
+            captured[-1][1].append((statement, parameters))
+
+        failures = 0
+        event.listen(async_engine.sync_engine, "before_cursor_execute", capture)
+        try:
+            for name, path in paths:
+                captured.append((name, []))
+                await path
+        finally:
+            event.remove(async_engine.sync_engine, "before_cursor_execute", capture)
+
+        for name, statements in captured:
+            for statement, parameters in statements:
+                if not statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE")):
+                    continue
+                scans, plan = await explain(connection, dialect, statement, parameters, tables)
+                if scans:
+                    failures += 1
+                    print(f"FAIL {name}: full scan of {', '.join(scans)}")
+                if scans or args.verbose:
+                    print(f"    {' '.join(statement.split())}")
+                    for line in plan:
+                        print(f"    {line}")
+        await session.rollback()
+
+    if failures:
+        print(f"{failures} statements read a whole table of {', '.join(sorted(tables))}")
+        return 1
+    print(f"No full scans of {', '.join(sorted(tables))}")
+    return 0
+
+
+async def main_async(args) -> int:
+    try:
+        return await check(args)
+    finally:
+        await async_engine.dispose()
+
+
+def main(argv=None) -> int:
+    return asyncio.run(main_async(parse_args(argv)))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
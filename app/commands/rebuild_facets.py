@@ -0,0 +1,54 @@
+"""Rebuild the facet count tables from the recommendations.
+
+    python -m app.commands.rebuild_facets
+
+The counts are maintained by the API, this is for drift after manual data
+changes, restores or bulk loads that bypass the API. Both tables are
+replaced in a single transaction.
+"""
+import argparse
+import sys
+
+from sqlalchemy import delete, func, insert, select
+
+from ..database import engine
+from ..models import Recommendation, RecommendationTagLink, TypeOfFictionCount,\
+    TagTypeOfFictionCount
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    return parser.parse_args(argv)
+
+
+def rebuild_facets(connection) -> tuple[int, int]:
+    connection.execute(delete(TypeOfFictionCount))
+    connection.execute(delete(TagTypeOfFictionCount))
+    types = connection.execute(
+        insert(TypeOfFictionCount).from_select(
+            ["type_of_fiction", "recommendation_count"],
+            select(Recommendation.type_of_fiction, func.count()).
+            group_by(Recommendation.type_of_fiction)
+        )
+    ).rowcount
+    tag_types = connection.execute(
+        insert(TagTypeOfFictionCount).from_select(
+            ["tag_id", "type_of_fiction", "recommendation_count"],
+            select(RecommendationTagLink.tag_id, Recommendation.type_of_fiction, func.count()).
+            join(Recommendation, Recommendation.id == RecommendationTagLink.recommendation_id).
+            group_by(RecommendationTagLink.tag_id, Recommendation.type_of_fiction)
+        )
+    ).rowcount
+    return types, tag_types
+
+
+def main(argv=None) -> int:
+    parse_args(argv)
+    with engine.begin() as connection:
+        types, tag_types = rebuild_facets(connection)
+    print(f"{types} type_of_fiction counts, {tag_types} tag/type_of_fiction counts")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,128 @@
+"""Rebuild the related recommendations table from scratch.
+
+    python -m app.commands.rebuild_related
+
+The API keeps the table up to date as recommendations are added and
+removed, but IDF weights drift as tags get more popular and lists that lost
+an entry stay short, so this is meant to run periodically (e.g. nightly).
+Recommendations are multiplied as sparse tag vectors, a block of rows at a
+time, and the lists of each block are replaced in a transaction of their
+own, so the API only ever waits for one block. Lists of recommendations
+added while the rebuild runs are left as the API wrote them.
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+from scipy import sparse
+from sqlalchemy import delete, func, insert, select
+
+from ..database import engine
+from ..models import Recommendation, RecommendationTagLink, RelatedRecommendation
+from ..related import RELATED_TOP_K, RELATED_MAX_TAG_RECOMMENDATIONS
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--top-k", type=int, default=RELATED_TOP_K)
+    parser.add_argument("--max-tag-recommendations", type=int,
+                        default=RELATED_MAX_TAG_RECOMMENDATIONS)
+    parser.add_argument("--block-size", type=int, default=500,
+                        help="recommendations scored and written per transaction")
+    return parser.parse_args(argv)
+
+
+def load_links(connection) -> tuple[np.ndarray, np.ndarray]:
+    recommendation_ids = []
+    tag_ids = []
+    result = connection.execution_options(yield_per=100000).execute(
+        select(RecommendationTagLink.recommendation_id, RecommendationTagLink.tag_id)
+    )
+    for partition in result.partitions():
+        for recommendation_id, tag_id in partition:
+            recommendation_ids.append(recommendation_id)
+            tag_ids.append(tag_id)
+    return np.array(recommendation_ids, dtype=np.int64), np.array(tag_ids, dtype=np.int64)
+
+
+def score_matrices(recommendation_ids: np.ndarray, tag_ids: np.ndarray, total: int,
+                   max_tag_recommendations: int):
+    ids, rows = np.unique(recommendation_ids, return_inverse=True)
+    tags, columns = np.unique(tag_ids, return_inverse=True)
+    counts = np.bincount(columns, minlength=len(tags))
+    # Same weights as app.related.idf, tags shared by nobody else can not
+    # relate anything.
+    weights = np.log(np.maximum(total, counts) / counts)
+    weights[(counts > max_tag_recommendations) | (counts < 2)] = 0
+    links = sparse.csr_matrix((np.ones(len(rows)), (rows, columns)),
+                              shape=(len(ids), len(tags)))
+    links.eliminate_zeros()
+    weighted = links.multiply(weights).tocsr()
+    weighted.eliminate_zeros()
+    return ids, weighted, links.T.tocsr()
+
+
+def top_k_blocks(ids: np.ndarray, weighted, links_t, top_k: int, block_size: int):
+    for start in range(0, weighted.shape[0], block_size):
+        scores = (weighted[start:start + block_size] @ links_t).tocsr()
+        rows = []
+        for offset in range(scores.shape[0]):
+            row = start + offset
+            begin, end = scores.indptr[offset], scores.indptr[offset + 1]
+            columns = scores.indices[begin:end]
+            values = scores.data[begin:end]
+            mask = (columns != row) & (values > 0)
+            columns, values = columns[mask], values[mask]
+            # Same order as app.related.top_related, by score, then id.
+            order = np.lexsort((ids[columns], values))[::-1][:top_k]
+            recommendation_id = int(ids[row])
+            rows.extend({"recommendation_id": recommendation_id, "related_id": int(ids[column]),
+                         "score": float(value)}
+                        for column, value in zip(columns[order], values[order]))
+        yield ids[start:start + block_size].tolist(), rows
+
+
+def rebuild(args) -> int:
+    start = time.perf_counter()
+    with engine.connect() as connection:
+        # The total of app.related.estimate_recommendation_total, both
+        # paths have to weigh tags the same way.
+        total = connection.execute(select(func.max(Recommendation.id))).scalar() or 0
+        recommendation_ids, tag_ids = load_links(connection)
+    print(f"loaded {len(recommendation_ids)} links in {time.perf_counter() - start:.1f}s")
+    if not len(recommendation_ids):
+        return 0
+
+    related = RelatedRecommendation.__table__
+    written = 0
+    ids, weighted, links_t = score_matrices(recommendation_ids, tag_ids, total,
+                                            args.max_tag_recommendations)
+    for block_ids, rows in top_k_blocks(ids, weighted, links_t, args.top_k, args.block_size):
+        with engine.begin() as connection:
+            connection.execute(delete(related).
+                               where(related.c.recommendation_id.in_(block_ids)))
+            if rows:
+                # Recommendations deleted since the links were read would
+                # fail the foreign key.
+                existing = set(connection.execute(
+                    select(Recommendation.id).
+                    where(Recommendation.id.in_({row["related_id"] for row in rows} |
+                                                set(block_ids)))
+                ).scalars())
+                rows = [row for row in rows if row["recommendation_id"] in existing and
+                        row["related_id"] in existing]
+            if rows:
+                connection.execute(insert(related), rows)
+        written += len(rows)
+    print(f"wrote {written} related rows in {time.perf_counter() - start:.1f}s")
+    return written
+
+
+def main(argv=None) -> int:
+    rebuild(parse_args(argv))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,50 @@
+"""Rebuild tag.recommendation_count from the recommendation/tag links.
+
+    python -m app.commands.reconcile_tag_counts
+
+The counters are maintained incrementally by the API, this is for drift
+after manual data changes, restores or bulk loads that bypass the API.
+"""
+import argparse
+import sys
+
+from sqlalchemy import func, select, update
+
+from ..database import engine
+from ..models import Tag, RecommendationTagLink
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dry-run", action="store_true",
+                        help="only report the number of wrong counters")
+    return parser.parse_args(argv)
+
+
+def reconcile_tag_counts(connection, dry_run: bool = False) -> int:
+    actual = select(func.count()).\
+        where(RecommendationTagLink.tag_id == Tag.id).\
+        scalar_subquery()
+    if dry_run:
+        return connection.execute(
+            select(func.count()).select_from(Tag).where(Tag.recommendation_count != actual)
+        ).scalar()
+    result = connection.execute(
+        update(Tag).
+        where(Tag.recommendation_count != actual).
+        values(recommendation_count=actual).
+        execution_options(synchronize_session=False)
+    )
+    return result.rowcount
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    with engine.begin() as connection:
+        wrong = reconcile_tag_counts(connection, dry_run=args.dry_run)
+    print(f"{wrong} tags {'have a wrong count' if args.dry_run else 'updated'}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,231 @@
+"""Fill the database with synthetic users, tags and recommendations.
+
+    python -m app.commands.seed --users 100000 --recommendations 1000000 \\
+        --tags 50000 --links 10000000 --seed 42
+
+Tag popularity follows a Zipf distribution and recommendations per user a
+Pareto one, so a few tags and users account for most rows. The same
+arguments always produce the same data. Rows are appended after the
+current maximum ids; on Postgres they are loaded with COPY, on SQLite with
+batched executemany.
+"""
+import argparse
+import bisect
+import csv
+import io
+import itertools
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, select, text
+
+from ..database import engine
+from ..hashing import pwd_context
+from ..models import User, Tag, Recommendation, RecommendationTagLink
+from .rebuild_facets import rebuild_facets
+from .reconcile_tag_counts import reconcile_tag_counts
+
+
+WORDS = ["dragon", "space", "time", "magic", "war", "love", "crime", "ghost",
+         "robot", "empire", "ocean", "forest", "city", "winter", "storm", "shadow",
+         "queen", "detective", "alien", "plague", "heist", "kingdom", "ai", "myth"]
+ADJECTIVES = ["dark", "epic", "cozy", "hard", "grim", "short", "classic", "weird",
+              "slow", "urban", "cosmic", "gothic", "military", "political", "comic", "noir"]
+TYPES_OF_FICTION = ["fantasy", "science-fiction", "horror", "mystery", "thriller",
+                    "romance", "historical", "literary", "young-adult", "dystopian"]
+SENTENCES = ["The pacing is uneven but the ending makes up for it.",
+             "One of the best world-building efforts in years.",
+             "Characters feel alive from the first chapter.",
+             "Not for everyone, but I could not put it down.",
+             "A slow start that turns into a relentless second half.",
+             "The prose is beautiful and the plot is tight.",
+             "Recommended for anyone who liked the classics of the genre.",
+             "Surprisingly funny for such a bleak setting."]
+
+COLUMNS = {
+    User: ["id", "username", "email", "hashed_password"],
+    Tag: ["id", "name"],
+    Recommendation: ["id", "type_of_fiction", "title", "short_description", "opinion",
+                     "published", "user_id"],
+    RecommendationTagLink: ["recommendation_id", "tag_id"],
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--recommendations", type=int, default=100000)
+    parser.add_argument("--tags", type=int, default=5000)
+    parser.add_argument("--links", type=int,
+                        help="recommendation/tag links, three per recommendation by default")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tag-zipf", type=float, default=1.07,
+                        help="exponent of the tag popularity distribution")
+    parser.add_argument("--user-pareto", type=float, default=1.5,
+                        help="shape of the recommendations per user distribution, "
+                             "lower is more skewed, 1.16 is roughly 80/20")
+    parser.add_argument("--password", default="password",
+                        help="password of every generated user")
+    parser.add_argument("--batch-size", type=int, default=50000)
+    return parser.parse_args(argv)
+
+
+def cumulative(weights) -> list[float]:
+    return list(itertools.accumulate(weights))
+
+
+def zipf_weights(n: int, exponent: float):
+    return (1 / rank ** exponent for rank in range(1, n + 1))
+
+
+def generate_users(rng: random.Random, first_id: int, count: int, hashed_password: str):
+    for id in range(first_id, first_id + count):
+        yield (id, f"{rng.choice(WORDS)}_{rng.choice(ADJECTIVES)}_{id}",
+               f"user{id}@example.com", hashed_password)
+
+
+def generate_tags(rng: random.Random, first_id: int, count: int):
+    # Names stay unique with the id appended, also next to the tags of an
+    # earlier run. The short names are only free in an empty table, there
+    # the most popular tags (the lowest ranks) get them.
+    names = [f"{adjective}-{word}" for adjective in ADJECTIVES for word in WORDS]
+    rng.shuffle(names)
+    for rank, id in enumerate(range(first_id, first_id + count)):
+        if first_id == 1 and rank < len(names):
+            yield id, names[rank]
+        else:
+            yield id, f"{names[rank % len(names)]}-{id}"
+
+
+def generate_recommendations(rng: random.Random, first_id: int, count: int,
+                             user_ids: range, user_pareto: float, batch_size: int):
+    user_weights = cumulative(rng.paretovariate(user_pareto) for _ in user_ids)
+    start = datetime(2020, 1, 1)
+    seconds = 5 * 365 * 24 * 3600
+    for batch_start in range(0, count, batch_size):
+        size = min(batch_size, count - batch_start)
+        owners = rng.choices(user_ids, cum_weights=user_weights, k=size)
+        for offset, user_id in enumerate(owners):
+            id = first_id + batch_start + offset
+            yield (id, rng.choice(TYPES_OF_FICTION),
+                   f"The {rng.choice(ADJECTIVES).title()} {rng.choice(WORDS).title()} {id}",
+                   " ".join(rng.sample(SENTENCES, 2)),
+                   " ".join(rng.sample(SENTENCES, 3)),
+                   (start + timedelta(seconds=rng.randrange(seconds))).isoformat(" ", "microseconds"),
+                   user_id)
+
+
+def generate_links(rng: random.Random, recommendation_ids: range, tag_ids: range,
+                   links: int, tag_zipf: float):
+    tag_weights = cumulative(zipf_weights(len(tag_ids), tag_zipf))
+    total = tag_weights[-1]
+    per_recommendation, extra = divmod(links, len(recommendation_ids))
+    with_extra = set(rng.sample(recommendation_ids, extra)) if extra else set()
+    for recommendation_id in recommendation_ids:
+        wanted = min(per_recommendation + (recommendation_id in with_extra), len(tag_ids))
+        chosen = set()
+        while len(chosen) < wanted:
+            rank = bisect.bisect(tag_weights, rng.random() * total)
+            chosen.add(tag_ids[min(rank, len(tag_ids) - 1)])
+        for tag_id in chosen:
+            yield recommendation_id, tag_id
+
+
+def batches(rows, size: int):
+    iterator = iter(rows)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+def copy_rows(connection, model, rows, batch_size: int) -> int:
+    table = model.__table__.name
+    columns = ", ".join(COLUMNS[model])
+    loaded = 0
+    cursor = connection.connection.cursor()
+    for batch in batches(rows, batch_size):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(batch)
+        buffer.seek(0)
+        cursor.copy_expert(f'COPY "{table}" ({columns}) FROM STDIN WITH (FORMAT csv)', buffer)
+        loaded += len(batch)
+    return loaded
+
+
+def insert_rows(connection, model, rows, batch_size: int) -> int:
+    table = model.__table__.name
+    columns = COLUMNS[model]
+    statement = (f'INSERT INTO "{table}" ({", ".join(columns)}) '
+                 f'VALUES ({", ".join("?" * len(columns))})')
+    loaded = 0
+    cursor = connection.connection.cursor()
+    for batch in batches(rows, batch_size):
+        cursor.executemany(statement, batch)
+        loaded += len(batch)
+    return loaded
+
+
+def max_id(connection, column) -> int:
+    return connection.execute(select(func.coalesce(func.max(column), 0))).scalar()
+
+
+def reset_sequences(connection):
+    for model in (User, Tag, Recommendation):
+        table = model.__table__.name
+        connection.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('\"{table}\"', 'id'), "
+            f"(SELECT COALESCE(MAX(id), 1) FROM \"{table}\"))"
+        ))
+
+
+def seed(args):
+    rng = random.Random(args.seed)
+    links = args.links if args.links is not None else args.recommendations * 3
+    if args.users <= 0 or args.tags <= 0:
+        raise SystemExit("--users and --tags must be positive")
+    hashed_password = pwd_context.hash(args.password)
+
+    with engine.begin() as connection:
+        postgres = connection.dialect.name == "postgresql"
+        load = copy_rows if postgres else insert_rows
+        if connection.dialect.name == "sqlite":
+            connection.exec_driver_sql("PRAGMA synchronous = OFF")
+        first_user = max_id(connection, User.id) + 1
+        first_tag = max_id(connection, Tag.id) + 1
+        first_recommendation = max_id(connection, Recommendation.id) + 1
+        user_ids = range(first_user, first_user + args.users)
+        tag_ids = range(first_tag, first_tag + args.tags)
+        recommendation_ids = range(first_recommendation,
+                                   first_recommendation + args.recommendations)
+
+        steps = [
+            (User, generate_users(rng, first_user, args.users, hashed_password)),
+            (Tag, generate_tags(rng, first_tag, args.tags)),
+            (Recommendation, generate_recommendations(rng, first_recommendation,
+                                                      args.recommendations, user_ids,
+                                                      args.user_pareto, args.batch_size)),
+            (RecommendationTagLink, generate_links(rng, recommendation_ids, tag_ids,
+                                                   links, args.tag_zipf)
+             if args.recommendations else ()),
+        ]
+        for model, rows in steps:
+            start = time.perf_counter()
+            loaded = load(connection, model, rows, args.batch_size)
+            elapsed = time.perf_counter() - start
+            print(f"{model.__table__.name}: {loaded} rows in {elapsed:.1f}s "
+                  f"({loaded / elapsed if elapsed else 0:.0f} rows/s)")
+        print(f"tag counts: {reconcile_tag_counts(connection)} tags updated")
+        types, tag_types = rebuild_facets(connection)
+        print(f"facet counts: {types} type_of_fiction, {tag_types} tag/type_of_fiction")
+        if postgres:
+            reset_sequences(connection)
+
+
+def main(argv=None) -> int:
+    seed(parse_args(argv))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,32 +1,420 @@
-from sqlmodel import Session, select
-from .models import User, Tag, Recommendation, RecommendationTagLink
+import re
+from collections import Counter
+from datetime import datetime
 
+from decouple import config
+from sqlalchemy import bindparam, column, delete, func, insert, literal_column, table, tuple_, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import make_transient_to_detached, selectinload
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from .cache import LRUCache
+from .models import User, Tag, Recommendation, RecommendationTagLink, TypeOfFictionCount,\
+    TagTypeOfFictionCount
+from .schemas import RecommendationCreate
 
-def get_user_with_username(session: Session, username: str):
-    return session.exec(select(User).where(User.username == username)).first()
 
+TAG_CACHE_SIZE = config("TAG_CACHE_SIZE", default=10000, cast=int)
+EXPORT_BATCH_SIZE = config("EXPORT_BATCH_SIZE", default=1000, cast=int)
 
-def get_user_with_email(session: Session, email: str):
-    return session.exec(select(User).where(User.email == email)).first()
+# Tags are never renamed or deleted, so a name -> id mapping that was read
+# from the database stays valid for the lifetime of the process.
+tag_ids_cache = LRUCache(max_size=TAG_CACHE_SIZE)
 
 
-def save_tags(session: Session, tags: list):
-    tags_objects = []
-    for tag in tags:
-        tag: str = tag.strip().replace(' ', '-')
-        existing_tag = session.exec(select(Tag).where(Tag.name == tag)).first()
-        if existing_tag:
-            tags_objects.append(existing_tag)
+async def get_user_with_username(session: AsyncSession, username: str):
+    result = await session.exec(select(User).where(User.username == username))
+    return result.first()
+
+
+async def get_user_with_email(session: AsyncSession, email: str):
+    result = await session.exec(select(User).where(User.email == email))
+    return result.first()
+
+
+def normalize_tag_name(name: str) -> str:
+    return name.strip().replace(' ', '-')
+
+
+async def _select_tag_ids(session: AsyncSession, names: list[str]) -> dict[str, int]:
+    result = await session.exec(select(Tag.id, Tag.name).where(Tag.name.in_(names)))
+    return {name: tag_id for tag_id, name in result}
+
+
+async def _insert_missing_tags(session: AsyncSession, names: list[str]) -> dict[str, int]:
+    rows = [{"name": name} for name in names]
+    dialect = session.bind.dialect.name
+    if dialect == "postgresql":
+        statement = postgresql.insert(Tag).values(rows).\
+            on_conflict_do_nothing(index_elements=["name"]).\
+            returning(Tag.id, Tag.name)
+        result = await session.execute(statement)
+        return {name: tag_id for tag_id, name in result}
+    if dialect == "sqlite":
+        statement = sqlite.insert(Tag).values(rows).\
+            on_conflict_do_nothing(index_elements=["name"])
+        await session.execute(statement)
+        return {}
+    raise NotImplementedError(f"Tag upsert is not implemented for {dialect}")
+
+
+async def resolve_tag_ids(session: AsyncSession, names: list[str]) -> dict[str, int]:
+    tag_ids = {}
+    missing = []
+    for name in dict.fromkeys(names):
+        tag_id = tag_ids_cache.get(name)
+        if tag_id is None:
+            missing.append(name)
         else:
-            new_tag = Tag(name=tag)
-            # session.add(new_tag)
-            # session.commit()
-            # session.refresh(new_tag)
-            tags_objects.append(new_tag)
+            tag_ids[name] = tag_id
+    if not missing:
+        return tag_ids
+
+    existing = await _select_tag_ids(session, missing)
+    for name, tag_id in existing.items():
+        tag_ids_cache.set(name, tag_id)
+    tag_ids.update(existing)
+    missing = [name for name in missing if name not in existing]
+    if not missing:
+        return tag_ids
+
+    # Ids of tags inserted here are not cached until they are read back,
+    # the transaction may still be rolled back.
+    inserted = await _insert_missing_tags(session, missing)
+    tag_ids.update(inserted)
+    # Rows that a concurrent transaction inserted first (and, on SQLite, all
+    # rows, as there is no RETURNING) have to be read back.
+    missing = [name for name in missing if name not in inserted]
+    if missing:
+        tag_ids.update(await _select_tag_ids(session, missing))
+    return tag_ids
+
+
+async def get_tag_id(session: AsyncSession, name: str) -> int | None:
+    name = normalize_tag_name(name)
+    tag_id = tag_ids_cache.get(name)
+    if tag_id is None:
+        tag_id = (await _select_tag_ids(session, [name])).get(name)
+        if tag_id is not None:
+            tag_ids_cache.set(name, tag_id)
+    return tag_id
+
+
+async def save_tags(session: AsyncSession, tags: list):
+    names = list(dict.fromkeys(normalize_tag_name(tag) for tag in tags))
+    tag_ids = await resolve_tag_ids(session, names)
+    tags_objects = []
+    for name in names:
+        tag = Tag(id=tag_ids[name], name=name)
+        # The row exists already, attach it to the session without a SELECT.
+        make_transient_to_detached(tag)
+        tags_objects.append(await session.merge(tag, load=False))
 
     return tags_objects
 
 
-def get_recommendation_by_id(session: Session, recommendation_id: int):
-    return session.exec(select(Recommendation).join(RecommendationTagLink).join(Tag).
-                        where(Recommendation.id == recommendation_id)).first()
+async def update_tag_counts(session: AsyncSession, deltas: dict[int, int]):
+    # Rows are updated in id order, so transactions that share tags lock
+    # them in the same order and can not deadlock on each other.
+    deltas = {tag_id: delta for tag_id, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    tag = Tag.__table__
+    statement = update(tag).\
+        where(tag.c.id == bindparam("tag_id")).\
+        values(recommendation_count=tag.c.recommendation_count + bindparam("delta"))
+    await session.execute(statement, [{"tag_id": tag_id, "delta": delta}
+                                      for tag_id, delta in sorted(deltas.items())])
+
+
+def _upsert_counts(dialect: str, model, index_elements: list[str]):
+    if dialect == "postgresql":
+        statement = postgresql.insert(model.__table__)
+    elif dialect == "sqlite":
+        statement = sqlite.insert(model.__table__)
+    else:
+        raise NotImplementedError(f"Count upsert is not implemented for {dialect}")
+    return statement.on_conflict_do_update(
+        index_elements=index_elements,
+        set_={"recommendation_count": model.__table__.c.recommendation_count +
+              statement.excluded.recommendation_count}
+    )
+
+
+async def update_facet_counts(session: AsyncSession, type_deltas: dict[str, int],
+                              tag_type_deltas: dict[tuple[int, str], int]):
+    # Same lock ordering as update_tag_counts. Rows that drop to 0 stay
+    # and are filtered out when read.
+    dialect = session.bind.dialect.name
+    type_deltas = sorted((type_of_fiction, delta)
+                         for type_of_fiction, delta in type_deltas.items() if delta)
+    if type_deltas:
+        await session.execute(
+            _upsert_counts(dialect, TypeOfFictionCount, ["type_of_fiction"]),
+            [{"type_of_fiction": type_of_fiction, "recommendation_count": delta}
+             for type_of_fiction, delta in type_deltas]
+        )
+    tag_type_deltas = sorted((key, delta) for key, delta in tag_type_deltas.items() if delta)
+    if tag_type_deltas:
+        await session.execute(
+            _upsert_counts(dialect, TagTypeOfFictionCount, ["tag_id", "type_of_fiction"]),
+            [{"tag_id": tag_id, "type_of_fiction": type_of_fiction,
+              "recommendation_count": delta}
+             for (tag_id, type_of_fiction), delta in tag_type_deltas]
+        )
+
+
+async def update_recommendation_counts(session: AsyncSession, type_of_fiction: str,
+                                       tag_ids: list[int], delta: int):
+    # For a single recommendation that is added (1) or removed (-1).
+    await update_tag_counts(session, {tag_id: delta for tag_id in tag_ids})
+    await update_facet_counts(session, {type_of_fiction: delta},
+                              {(tag_id, type_of_fiction): delta for tag_id in tag_ids})
+
+
+async def delete_user_recommendations(session: AsyncSession, user_id: int,
+                                      limit: int) -> list[int]:
+    # Deletes up to `limit` recommendations of the user and returns their
+    # ids, the links and related rows go with them by ON DELETE CASCADE.
+    result = await session.execute(
+        select(Recommendation.id, Recommendation.type_of_fiction).
+        where(Recommendation.user_id == user_id).limit(limit)
+    )
+    rows = result.all()
+    if not rows:
+        return []
+    recommendation_ids = [recommendation_id for recommendation_id, _ in rows]
+    result = await session.execute(
+        select(RecommendationTagLink.tag_id, Recommendation.type_of_fiction, func.count()).
+        join(Recommendation, Recommendation.id == RecommendationTagLink.recommendation_id).
+        where(RecommendationTagLink.recommendation_id.in_(recommendation_ids)).
+        group_by(RecommendationTagLink.tag_id, Recommendation.type_of_fiction)
+    )
+    tag_deltas = Counter()
+    tag_type_deltas = {}
+    for tag_id, type_of_fiction, count in result:
+        tag_deltas[tag_id] -= count
+        tag_type_deltas[(tag_id, type_of_fiction)] = -count
+    type_deltas = Counter()
+    for _, type_of_fiction in rows:
+        type_deltas[type_of_fiction] -= 1
+    await update_tag_counts(session, tag_deltas)
+    await update_facet_counts(session, type_deltas, tag_type_deltas)
+    recommendation = Recommendation.__table__
+    await session.execute(
+        delete(recommendation).where(recommendation.c.id.in_(recommendation_ids))
+    )
+    return recommendation_ids
+
+
+async def get_tag_with_name(session: AsyncSession, name: str):
+    result = await session.exec(select(Tag).where(Tag.name == normalize_tag_name(name)))
+    return result.first()
+
+
+async def get_popular_tags(session: AsyncSession, limit: int):
+    result = await session.exec(select(Tag).
+                                where(Tag.recommendation_count > 0).
+                                order_by(Tag.recommendation_count.desc(), Tag.id.desc()).
+                                limit(limit))
+    return result.all()
+
+
+async def get_type_of_fiction_counts(session: AsyncSession, limit: int,
+                                     tag_id: int | None = None):
+    if tag_id is None:
+        value = TypeOfFictionCount.type_of_fiction
+        count = TypeOfFictionCount.recommendation_count
+        statement = select(value, count)
+    else:
+        value = TagTypeOfFictionCount.type_of_fiction
+        count = TagTypeOfFictionCount.recommendation_count
+        statement = select(value, count).where(TagTypeOfFictionCount.tag_id == tag_id)
+    result = await session.execute(statement.where(count > 0).
+                                   order_by(count.desc(), value).
+                                   limit(limit))
+    return result.all()
+
+
+async def get_tag_counts(session: AsyncSession, limit: int,
+                         type_of_fiction: str | None = None):
+    if type_of_fiction is None:
+        count = Tag.recommendation_count
+        statement = select(Tag.name, count).order_by(count.desc(), Tag.id.desc())
+    else:
+        count = TagTypeOfFictionCount.recommendation_count
+        statement = select(Tag.name, count).\
+            join(Tag, Tag.id == TagTypeOfFictionCount.tag_id).\
+            where(TagTypeOfFictionCount.type_of_fiction == type_of_fiction).\
+            order_by(count.desc(), TagTypeOfFictionCount.tag_id.desc())
+    result = await session.execute(statement.where(count > 0).limit(limit))
+    return result.all()
+
+
+async def get_recommendation_by_id(session: AsyncSession, recommendation_id: int):
+    result = await session.exec(select(Recommendation).
+                                where(Recommendation.id == recommendation_id).
+                                options(selectinload(Recommendation.tags)))
+    return result.first()
+
+
+async def get_recommendations_by_ids(session: AsyncSession, recommendation_ids: list[int]):
+    # selectinload loads the tags of all rows with one more IN query.
+    result = await session.exec(select(Recommendation).
+                                where(Recommendation.id.in_(recommendation_ids)).
+                                options(selectinload(Recommendation.tags)))
+    recommendations = {recommendation.id: recommendation for recommendation in result}
+    return [recommendations[id] for id in recommendation_ids if id in recommendations]
+
+
+def _filter_recommendations(statement, *, user_id: int | None = None,
+                            tag_id: int | None = None,
+                            type_of_fiction: str | None = None):
+    if user_id is not None:
+        statement = statement.where(Recommendation.user_id == user_id)
+    if type_of_fiction is not None:
+        statement = statement.where(Recommendation.type_of_fiction == type_of_fiction)
+    if tag_id is not None:
+        statement = statement.where(
+            select(RecommendationTagLink.recommendation_id).
+            where(RecommendationTagLink.recommendation_id == Recommendation.id,
+                  RecommendationTagLink.tag_id == tag_id).
+            exists()
+        )
+    return statement
+
+
+async def list_recommendations(session: AsyncSession, *, limit: int,
+                               after: tuple[datetime, int] | None = None,
+                               user_id: int | None = None,
+                               tag_id: int | None = None,
+                               type_of_fiction: str | None = None):
+    # Newest first, ties on published are broken by id so that the
+    # (published, id) pair of the last row is a stable cursor.
+    statement = select(Recommendation).options(selectinload(Recommendation.tags))
+    statement = _filter_recommendations(statement, user_id=user_id, tag_id=tag_id,
+                                        type_of_fiction=type_of_fiction)
+    if after is not None:
+        statement = statement.where(
+            tuple_(Recommendation.published, Recommendation.id) < tuple_(*after))
+    statement = statement.order_by(Recommendation.published.desc(),
+                                   Recommendation.id.desc()).limit(limit)
+    result = await session.exec(statement)
+    return result.all()
+
+
+recommendation_fts = table("recommendation_fts", column("rowid"))
+
+
+def _search_statement(dialect: str, query: str):
+    if dialect == "postgresql":
+        search_vector = literal_column("recommendation.search_vector")
+        ts_query = func.websearch_to_tsquery(literal_column("'english'::regconfig"), query)
+        return select(Recommendation).\
+            where(search_vector.op("@@")(ts_query)).\
+            order_by(func.ts_rank(search_vector, ts_query).desc(),
+                     Recommendation.id.desc())
+    if dialect == "sqlite":
+        # Every word is quoted, so FTS5 query syntax in user input is
+        # matched literally instead of failing to parse.
+        words = re.findall(r"\w+", query)
+        if not words:
+            return None
+        match = " ".join(f'"{word}"' for word in words)
+        fts = literal_column("recommendation_fts")
+        return select(Recommendation).\
+            join(recommendation_fts, recommendation_fts.c.rowid == Recommendation.id).\
+            where(fts.op("MATCH")(match)).\
+            order_by(func.bm25(fts, 10.0, 4.0, 1.0), Recommendation.id.desc())
+    raise NotImplementedError(f"Search is not implemented for {dialect}")
+
+
+async def search_recommendations(session: AsyncSession, query: str, *,
+                                 limit: int, offset: int = 0,
+                                 tag_id: int | None = None,
+                                 type_of_fiction: str | None = None):
+    statement = _search_statement(session.bind.dialect.name, query)
+    if statement is None:
+        return []
+    statement = _filter_recommendations(statement, tag_id=tag_id,
+                                        type_of_fiction=type_of_fiction)
+    statement = statement.options(selectinload(Recommendation.tags)).\
+        offset(offset).limit(limit)
+    result = await session.exec(statement)
+    return result.all()
+
+
+async def iter_user_recommendations(session: AsyncSession, user_id: int,
+                                    batch_size: int = EXPORT_BATCH_SIZE):
+    # Plain rows are read through a server side cursor instead of ORM
+    # objects, so nothing accumulates in the identity map, and the tags of
+    # every batch are loaded with one query.
+    columns = [Recommendation.id, Recommendation.type_of_fiction, Recommendation.title,
+               Recommendation.short_description, Recommendation.opinion,
+               Recommendation.published, Recommendation.updated]
+    statement = select(*columns).\
+        where(Recommendation.user_id == user_id).\
+        order_by(Recommendation.published, Recommendation.id).\
+        execution_options(yield_per=batch_size)
+    result = await session.stream(statement)
+    async for partition in result.partitions(batch_size):
+        recommendations = {row.id: {**row._asdict(), "tags": []} for row in partition}
+        tags = await session.execute(
+            select(RecommendationTagLink.recommendation_id, Tag.id, Tag.name).
+            join(Tag, Tag.id == RecommendationTagLink.tag_id).
+            where(RecommendationTagLink.recommendation_id.in_(recommendations))
+        )
+        for recommendation_id, tag_id, name in tags:
+            recommendations[recommendation_id]["tags"].append({"id": tag_id, "name": name})
+        yield list(recommendations.values())
+
+
+async def _insert_recommendation_rows(session: AsyncSession, rows: list[dict]) -> list[int]:
+    dialect = session.bind.dialect.name
+    if dialect == "postgresql":
+        # Ids are taken from the sequence up front, so the rows can go in
+        # with a single executemany and every id is known to belong to
+        # its row.
+        result = await session.execute(
+            select(func.nextval("recommendation_id_seq")).
+            select_from(func.generate_series(1, len(rows)))
+        )
+        ids = result.scalars().all()
+        for row, id in zip(rows, ids):
+            row["id"] = id
+        await session.execute(insert(Recommendation), rows)
+        return ids
+    # SQLite has no sequences. After the first insert this transaction
+    # holds the write lock and the new rowid is max(rowid) + 1, so the ids
+    # following it are free to be assigned to the remaining rows.
+    result = await session.execute(insert(Recommendation).values(**rows[0]))
+    first_id = result.inserted_primary_key[0]
+    ids = list(range(first_id, first_id + len(rows)))
+    for row, id in zip(rows[1:], ids[1:]):
+        row["id"] = id
+    if len(rows) > 1:
+        await session.execute(insert(Recommendation), rows[1:])
+    return ids
+
+
+async def insert_recommendations(session: AsyncSession, user_id: int,
+                                 items: list[RecommendationCreate],
+                                 tag_ids: dict[str, int]) -> list[int]:
+    published = datetime.utcnow()
+    rows = [{"type_of_fiction": item.type_of_fiction,
+             "title": item.title,
+             "short_description": item.short_description,
+             "opinion": item.opinion,
+             "published": published,
+             "user_id": user_id} for item in items]
+    ids = await _insert_recommendation_rows(session, rows)
+    links = [{"recommendation_id": id, "tag_id": tag_ids[name]}
+             for id, item in zip(ids, items)
+             for name in dict.fromkeys(normalize_tag_name(tag) for tag in item.tags)]
+    await session.execute(insert(RecommendationTagLink), links)
+    await update_tag_counts(session, Counter(link["tag_id"] for link in links))
+    types = {id: item.type_of_fiction for id, item in zip(ids, items)}
+    await update_facet_counts(session, Counter(types.values()),
+                              Counter((link["tag_id"], types[link["recommendation_id"]])
+                                      for link in links))
+    return ids
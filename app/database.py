@@ -1,12 +1,338 @@
-from sqlmodel import Session, create_engine
+import asyncio
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import Annotated
+
+from fastapi import Depends, Request, Response
+from sqlalchemy import event, exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlmodel import create_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
 from decouple import config
 
+from .instrumentation import instrument_engine
+from .metrics import DB_POOL_CHECKED_OUT, DB_POOL_OVERFLOW, DB_POOL_TIMEOUTS, DB_POOL_WAIT,\
+    DB_REPLICA_LAG, DB_REPLICA_FALLBACKS
+
 
 DATABASE_URL = config("DATABASE_URL")
 
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+
+def get_async_database_url(url: str) -> str:
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver configured for '{backend}' databases")
+    return url.set(drivername=ASYNC_DRIVERS[backend]).render_as_string(
+        hide_password=False)
+
+
+ASYNC_DATABASE_URL = config("ASYNC_DATABASE_URL",
+                            default=get_async_database_url(DATABASE_URL))
+
+DATABASE_POOL_SIZE = config("DATABASE_POOL_SIZE", default=5, cast=int)
+DATABASE_MAX_OVERFLOW = config("DATABASE_MAX_OVERFLOW", default=10, cast=int)
+DATABASE_POOL_TIMEOUT = config("DATABASE_POOL_TIMEOUT", default=30, cast=float)
+# Connections older than this are replaced, so a failover or a proxy idle
+# timeout never hands out a connection that died in the pool.
+DATABASE_POOL_RECYCLE = config("DATABASE_POOL_RECYCLE", default=1800, cast=int)
+DATABASE_POOL_PRE_PING = config("DATABASE_POOL_PRE_PING", default=True, cast=bool)
+DATABASE_POOL_WARMUP = config("DATABASE_POOL_WARMUP", default=DATABASE_POOL_SIZE, cast=int)
+
+# Optional read replica for GET routes. Any database the primary's schema
+# was migrated into works, locally a copy of a SQLite file will do.
+DATABASE_REPLICA_URL = config("DATABASE_REPLICA_URL", default="")
+ASYNC_DATABASE_REPLICA_URL = config(
+    "ASYNC_DATABASE_REPLICA_URL",
+    default=get_async_database_url(DATABASE_REPLICA_URL) if DATABASE_REPLICA_URL else ""
+)
+# Reads go to the primary while the replica is further behind than this,
+# or could not be reached at the last check.
+DATABASE_REPLICA_MAX_LAG = config("DATABASE_REPLICA_MAX_LAG", default=5, cast=float)
+DATABASE_REPLICA_CHECK_INTERVAL = config("DATABASE_REPLICA_CHECK_INTERVAL",
+                                         default=5, cast=float)
+DATABASE_REPLICA_CHECK_TIMEOUT = config("DATABASE_REPLICA_CHECK_TIMEOUT",
+                                        default=1, cast=float)
+# After a write the client reads from the primary for this long, so it sees
+# its own changes even though the replica has not replayed them yet.
+DATABASE_REPLICA_STICKY_SECONDS = config("DATABASE_REPLICA_STICKY_SECONDS",
+                                         default=DATABASE_REPLICA_MAX_LAG, cast=float)
+READ_PRIMARY_COOKIE = "read_primary_until"
+
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    # Time spent in _do_get covers waiting for a connection to be returned
+    # and opening a new one when the pool may still grow.
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.wait_seconds_total = 0.0
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            self.timeouts += 1
+            DB_POOL_TIMEOUTS.inc()
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            self.checkouts += 1
+            self.wait_seconds_total += elapsed
+            self.max_wait_seconds = max(self.max_wait_seconds, elapsed)
+            DB_POOL_WAIT.observe(elapsed)
+
+    def stats(self) -> dict:
+        return {"size": self.size(),
+                "max_overflow": self._max_overflow,
+                "checked_out": self.checkedout(),
+                "checked_in": self.checkedin(),
+                "overflow": max(self.overflow(), 0),
+                "checkouts": self.checkouts,
+                "wait_seconds_total": self.wait_seconds_total,
+                "max_wait_seconds": self.max_wait_seconds,
+                "timeouts": self.timeouts}
+
+
+def get_pool_options(url: str) -> dict:
+    # In memory SQLite databases live in a single connection and keep the
+    # pool their dialect picks.
+    url = make_url(url)
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        return {}
+    return {"poolclass": InstrumentedPool,
+            "pool_size": DATABASE_POOL_SIZE,
+            "max_overflow": DATABASE_MAX_OVERFLOW,
+            "pool_timeout": DATABASE_POOL_TIMEOUT,
+            "pool_recycle": DATABASE_POOL_RECYCLE,
+            "pool_pre_ping": DATABASE_POOL_PRE_PING}
+
+
+# The sync engine is kept for scripts and migrations, the application
+# itself talks to the database through the async engine.
 engine = create_engine(DATABASE_URL)
 
+async_engine = create_async_engine(ASYNC_DATABASE_URL,
+                                   **get_pool_options(ASYNC_DATABASE_URL))
+
+replica_engine = create_async_engine(
+    ASYNC_DATABASE_REPLICA_URL, **get_pool_options(ASYNC_DATABASE_REPLICA_URL)
+) if ASYNC_DATABASE_REPLICA_URL else None
+
+instrument_engine(engine)
+instrument_engine(async_engine.sync_engine)
+if replica_engine is not None:
+    instrument_engine(replica_engine.sync_engine)
+
+
+def enable_sqlite_foreign_keys(engine):
+    # SQLite only enforces foreign keys, and with them ON DELETE CASCADE,
+    # on connections that turned them on.
+    if engine.dialect.name != "sqlite":
+        return
+
+    @event.listens_for(engine, "connect")
+    def _on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+
+enable_sqlite_foreign_keys(engine)
+enable_sqlite_foreign_keys(async_engine.sync_engine)
+
+
+# The gauges follow checkouts as they happen, which keeps the per-worker
+# values current without reading the pool at scrape time.
+@event.listens_for(async_engine.sync_engine.pool, "checkout")
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    DB_POOL_CHECKED_OUT.inc()
+    if isinstance(async_engine.pool, InstrumentedPool):
+        DB_POOL_OVERFLOW.set(max(async_engine.pool.overflow(), 0))
+
+
+@event.listens_for(async_engine.sync_engine.pool, "checkin")
+def _on_checkin(dbapi_connection, connection_record):
+    DB_POOL_CHECKED_OUT.dec()
+    if isinstance(async_engine.pool, InstrumentedPool):
+        DB_POOL_OVERFLOW.set(max(async_engine.pool.overflow(), 0))
+
+
+async_session = sessionmaker(async_engine, class_=AsyncSession,
+                             expire_on_commit=False)
+replica_session = sessionmaker(replica_engine, class_=AsyncSession,
+                               expire_on_commit=False) if replica_engine is not None else None
+
+# Behind by more than the replay of the last transaction; on a primary or
+# a replica that has replayed everything it received the lag is 0.
+POSTGRESQL_REPLICA_LAG = """
+SELECT CASE
+    WHEN NOT pg_is_in_recovery() THEN 0
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+END
+"""
 
-def get_session():
-    with Session(engine) as session:
+
+class ReplicaMonitor:
+    # The replica is checked in the background at most once per interval,
+    # requests only read the outcome of the last check.
+    def __init__(self, engine):
+        self.engine = engine
+        self.healthy = True
+        self.lag = None
+        self.checked_at = None
+        self.error = None
+        self.fallbacks = 0
+        self._task = None
+
+    async def measure_lag(self) -> float:
+        async with self.engine.connect() as connection:
+            if connection.dialect.name == "postgresql":
+                result = await connection.exec_driver_sql(POSTGRESQL_REPLICA_LAG)
+                return float(result.scalar())
+            await connection.exec_driver_sql("SELECT 1")
+            return 0.0
+
+    async def check(self):
+        try:
+            self.lag = await asyncio.wait_for(self.measure_lag(),
+                                              DATABASE_REPLICA_CHECK_TIMEOUT)
+        except (exc.SQLAlchemyError, OSError, asyncio.TimeoutError) as e:
+            self.healthy = False
+            self.lag = None
+            self.error = repr(e)
+        else:
+            self.healthy = self.lag <= DATABASE_REPLICA_MAX_LAG
+            self.error = None if self.healthy else "lagging"
+            DB_REPLICA_LAG.set(self.lag)
+        self.checked_at = time.monotonic()
+
+    def available(self) -> bool:
+        stale = (self.checked_at is None or
+                 time.monotonic() - self.checked_at > DATABASE_REPLICA_CHECK_INTERVAL)
+        if stale and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self.check())
+        return self.healthy
+
+    def mark_down(self, error: BaseException):
+        self.healthy = False
+        self.error = repr(error)
+        self.checked_at = time.monotonic()
+
+    def stats(self) -> dict:
+        pool = self.engine.pool
+        return {"healthy": self.healthy,
+                "lag_seconds": self.lag,
+                "error": self.error,
+                "fallbacks": self.fallbacks,
+                "pool": pool.stats() if isinstance(pool, InstrumentedPool)
+                else {"pool": type(pool).__name__}}
+
+
+replica_monitor = ReplicaMonitor(replica_engine) if replica_engine is not None else None
+
+
+async def get_session():
+    async with async_session() as session:
+        yield session
+
+
+def reads_from_primary(request: Request) -> bool:
+    try:
+        return float(request.cookies.get(READ_PRIMARY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+@asynccontextmanager
+async def read_session(use_primary: bool = False):
+    session = None
+    if replica_monitor is not None and not use_primary:
+        if replica_monitor.available():
+            session = replica_session()
+            try:
+                # Connect up front, so that an unreachable replica falls
+                # back to the primary instead of failing the request.
+                await session.connection()
+            except (exc.SQLAlchemyError, OSError) as e:
+                await session.close()
+                session = None
+                replica_monitor.mark_down(e)
+                DB_REPLICA_FALLBACKS.labels("error").inc()
+        else:
+            DB_REPLICA_FALLBACKS.labels("unhealthy").inc()
+        if session is None:
+            replica_monitor.fallbacks += 1
+    if session is None:
+        session = async_session()
+    async with session:
         yield session
+
+
+async def get_read_session(request: Request):
+    async with read_session(use_primary=reads_from_primary(request)) as session:
+        yield session
+
+
+async def get_write_session(response: Response,
+                            session: Annotated[AsyncSession, Depends(get_session)]):
+    # Shares the session of get_current_user and makes the following
+    # reads of this client go to the primary.
+    if replica_engine is not None:
+        response.set_cookie(READ_PRIMARY_COOKIE,
+                            f"{time.time() + DATABASE_REPLICA_STICKY_SECONDS:.3f}",
+                            max_age=math.ceil(DATABASE_REPLICA_STICKY_SECONDS),
+                            httponly=True, samesite="lax")
+    return session
+
+
+def pool_stats() -> dict:
+    pool = async_engine.pool
+    if isinstance(pool, InstrumentedPool):
+        return pool.stats()
+    return {"pool": type(pool).__name__}
+
+
+def replica_stats() -> dict | None:
+    return replica_monitor.stats() if replica_monitor is not None else None
+
+
+async def _warm_engine(engine, connections: int):
+    # Connections are opened concurrently and held until all of them are
+    # established, otherwise the same one would be reused every time.
+    if not isinstance(engine.pool, InstrumentedPool):
+        return
+    connections = min(connections, DATABASE_POOL_SIZE)
+    if connections <= 0:
+        return
+    opened = await asyncio.gather(*(engine.connect() for _ in range(connections)),
+                                  return_exceptions=True)
+    for connection in opened:
+        if not isinstance(connection, BaseException):
+            await connection.close()
+
+
+async def warm_pool(connections: int = DATABASE_POOL_WARMUP):
+    await _warm_engine(async_engine, connections)
+    if replica_engine is not None:
+        await _warm_engine(replica_engine, connections)
+        await replica_monitor.check()
+
+
+async def dispose_engines():
+    await async_engine.dispose()
+    if replica_engine is not None:
+        await replica_engine.dispose()
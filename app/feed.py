@@ -0,0 +1,306 @@
+import asyncio
+import bisect
+import json
+from abc import ABC, abstractmethod
+from datetime import datetime
+
+from decouple import config
+from sqlalchemy import event, exc, func, select
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from .crud import get_recommendation_by_id, list_recommendations
+from .database import DATABASE_URL, async_session
+from .models import Recommendation
+from .serialization import serialize_recommendation
+
+
+# The newest LATEST_FEED_SIZE recommendations are kept serialized in every
+# worker, pages hold at most LATEST_FEED_PAGE_SIZE of them. The margin
+# between the two absorbs deletes, the buffer is only reloaded from the
+# database once it gets shorter than a page.
+LATEST_FEED_SIZE = config("LATEST_FEED_SIZE", default=100, cast=int)
+LATEST_FEED_PAGE_SIZE = config("LATEST_FEED_PAGE_SIZE", default=50, cast=int)
+# Workers tell each other about new and deleted recommendations through
+# LISTEN/NOTIFY on PostgreSQL. The memory channel only reaches the worker
+# that made the change, it is meant for SQLite and tests.
+LATEST_FEED_CHANNEL = config(
+    "LATEST_FEED_CHANNEL",
+    default="postgres" if make_url(DATABASE_URL).get_backend_name() == "postgresql" else "memory"
+)
+LATEST_FEED_KEEPALIVE_SECONDS = config("LATEST_FEED_KEEPALIVE_SECONDS", default=30, cast=float)
+LATEST_FEED_RECONNECT_SECONDS = config("LATEST_FEED_RECONNECT_SECONDS", default=1, cast=float)
+
+NOTIFY_CHANNEL = "latest_recommendations"
+# PostgreSQL rejects NOTIFY payloads of 8000 bytes or more, larger messages
+# are sent without the body and the listeners read the row instead.
+MAX_NOTIFY_PAYLOAD = 7900
+PENDING_MESSAGES = "latest_feed_messages"
+
+_background_tasks = set()
+
+
+def _in_background(coroutine):
+    task = asyncio.ensure_future(coroutine)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+class LatestFeed:
+    def __init__(self, size: int, page_size: int):
+        self.size = size
+        self.page_size = page_size
+        # Oldest first, in (published, id) order.
+        self._keys: list[tuple[datetime, int]] = []
+        self._bodies: list[bytes] = []
+        self.loaded = False
+        # The database had no more rows than the buffer at the last load.
+        self.complete = False
+        self.reloads = 0
+        self._lock = asyncio.Lock()
+        self._changes: list[tuple] | None = None
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, published: datetime, recommendation_id: int, body: bytes):
+        if self._changes is not None:
+            self._changes.append(("add", published, recommendation_id, body))
+        key = (published, recommendation_id)
+        index = bisect.bisect_left(self._keys, key)
+        if index < len(self._keys) and self._keys[index] == key:
+            return
+        if len(self._keys) >= self.size and index == 0:
+            return
+        self._keys.insert(index, key)
+        self._bodies.insert(index, body)
+        if len(self._keys) > self.size:
+            del self._keys[0], self._bodies[0]
+            self.complete = False
+
+    def remove(self, recommendation_id: int):
+        if self._changes is not None:
+            self._changes.append(("remove", recommendation_id))
+        for index, (_, key_id) in enumerate(self._keys):
+            if key_id == recommendation_id:
+                del self._keys[index], self._bodies[index]
+                return
+
+    def needs_reload(self) -> bool:
+        return not self.loaded or (not self.complete and len(self._keys) < self.page_size)
+
+    async def reload(self, if_needed: bool = False):
+        async with self._lock:
+            # Requests that queued up behind a reload find the buffer
+            # refreshed and return.
+            if if_needed and not self.needs_reload():
+                return
+            # Changes that arrive while the rows are read are applied again
+            # on top of them, the query may or may not have seen them.
+            self._changes = []
+            try:
+                async with async_session() as session:
+                    recommendations = await list_recommendations(session=session,
+                                                                 limit=self.size)
+                changes = self._changes
+            finally:
+                self._changes = None
+            self._keys = [(recommendation.published, recommendation.id)
+                          for recommendation in reversed(recommendations)]
+            self._bodies = [serialize_recommendation(recommendation)
+                            for recommendation in reversed(recommendations)]
+            self.complete = len(recommendations) < self.size
+            for change in changes:
+                if change[0] == "add":
+                    self.add(*change[1:])
+                else:
+                    self.remove(change[1])
+            self.loaded = True
+            self.reloads += 1
+
+    async def load_recommendation(self, recommendation_id: int):
+        async with async_session() as session:
+            recommendation = await get_recommendation_by_id(session=session,
+                                                            recommendation_id=recommendation_id)
+        if recommendation is not None:
+            self.add(recommendation.published, recommendation.id,
+                     serialize_recommendation(recommendation))
+
+    async def page(self, limit: int) -> bytes:
+        if self.needs_reload():
+            await self.reload(if_needed=True)
+        return b"[" + b",".join(reversed(self._bodies[-limit:])) + b"]"
+
+    def apply(self, message: dict):
+        operation = message["op"]
+        if operation == "add":
+            if "body" in message:
+                self.add(datetime.fromisoformat(message["published"]), message["id"],
+                         message["body"].encode())
+            else:
+                _in_background(self.load_recommendation(message["id"]))
+        elif operation == "remove":
+            self.remove(message["id"])
+            if self.needs_reload():
+                _in_background(self.reload(if_needed=True))
+        elif operation == "reload":
+            _in_background(self.reload())
+
+    def stats(self) -> dict:
+        return {"size": len(self._keys),
+                "max_size": self.size,
+                "complete": self.complete,
+                "reloads": self.reloads,
+                "channel": feed_channel.stats()}
+
+
+latest_feed = LatestFeed(LATEST_FEED_SIZE, LATEST_FEED_PAGE_SIZE)
+
+
+class FeedChannel(ABC):
+    @abstractmethod
+    async def publish(self, session: AsyncSession, message: dict):
+        # Called inside the transaction that makes the change, the message
+        # is delivered when it commits.
+        ...
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def stats(self) -> dict:
+        return {}
+
+
+class MemoryFeedChannel(FeedChannel):
+    async def publish(self, session: AsyncSession, message: dict):
+        session.sync_session.info.setdefault(PENDING_MESSAGES, []).append(message)
+
+    def stats(self) -> dict:
+        return {"backend": "memory"}
+
+
+@event.listens_for(Session, "after_commit")
+def _deliver_messages(session):
+    for message in session.info.pop(PENDING_MESSAGES, ()):
+        latest_feed.apply(message)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _drop_messages(session, previous_transaction):
+    session.info.pop(PENDING_MESSAGES, None)
+
+
+class PostgresFeedChannel(FeedChannel):
+    def __init__(self, url: str):
+        try:
+            import asyncpg
+        except ImportError:
+            raise RuntimeError("The asyncpg package is required for the postgres feed channel")
+        self._asyncpg = asyncpg
+        self._errors = (exc.SQLAlchemyError, OSError, asyncio.TimeoutError,
+                        asyncpg.PostgresError, asyncpg.InterfaceError)
+        # asyncpg takes plain postgresql:// URLs.
+        self.url = make_url(url).set(drivername="postgresql").render_as_string(
+            hide_password=False)
+        self.connected = False
+        self.connects = 0
+        self.error = None
+        self._task = None
+
+    async def publish(self, session: AsyncSession, message: dict):
+        payload = json.dumps(message)
+        if len(payload.encode()) > MAX_NOTIFY_PAYLOAD:
+            payload = json.dumps({key: value for key, value in message.items()
+                                  if key != "body"})
+        await session.execute(select(func.pg_notify(NOTIFY_CHANNEL, payload)))
+
+    async def start(self):
+        self._task = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    def _on_notification(self, connection, pid, channel, payload):
+        latest_feed.apply(json.loads(payload))
+
+    async def _listen(self):
+        # A connection of its own, outside the pool, LISTEN lasts as long
+        # as the session does.
+        while True:
+            try:
+                connection = await self._asyncpg.connect(self.url)
+            except self._errors as e:
+                self.error = repr(e)
+                await asyncio.sleep(LATEST_FEED_RECONNECT_SECONDS)
+                continue
+            try:
+                closed = asyncio.Event()
+                connection.add_termination_listener(lambda _: closed.set())
+                await connection.add_listener(NOTIFY_CHANNEL, self._on_notification)
+                self.connected = True
+                self.connects += 1
+                self.error = None
+                # Whatever was sent while nobody listened is lost.
+                await latest_feed.reload()
+                while not closed.is_set():
+                    try:
+                        await asyncio.wait_for(closed.wait(), LATEST_FEED_KEEPALIVE_SECONDS)
+                    except asyncio.TimeoutError:
+                        # Finds out about a connection that died silently.
+                        await connection.execute("SELECT 1",
+                                                 timeout=LATEST_FEED_KEEPALIVE_SECONDS)
+            except self._errors as e:
+                self.error = repr(e)
+            finally:
+                self.connected = False
+                connection.terminate()
+            await asyncio.sleep(LATEST_FEED_RECONNECT_SECONDS)
+
+    def stats(self) -> dict:
+        return {"backend": "postgres",
+                "connected": self.connected,
+                "connects": self.connects,
+                "error": self.error}
+
+
+def create_feed_channel(backend: str, *, url: str | None = None) -> FeedChannel:
+    if backend == "memory":
+        return MemoryFeedChannel()
+    if backend == "postgres":
+        return PostgresFeedChannel(url)
+    raise ValueError(f"Unknown latest feed channel '{backend}'")
+
+
+feed_channel = create_feed_channel(LATEST_FEED_CHANNEL, url=DATABASE_URL)
+
+
+async def publish_added(session: AsyncSession, recommendation: Recommendation):
+    # The recommendation has to be flushed, with its tags.
+    await feed_channel.publish(session, {
+        "op": "add",
+        "id": recommendation.id,
+        "published": recommendation.published.isoformat(),
+        "body": serialize_recommendation(recommendation).decode()
+    })
+
+
+async def publish_removed(session: AsyncSession, recommendation_id: int):
+    await feed_channel.publish(session, {"op": "remove", "id": recommendation_id})
+
+
+async def publish_reload(session: AsyncSession):
+    await feed_channel.publish(session, {"op": "reload"})
+
+
+async def start_latest_feed():
+    await latest_feed.reload()
+    await feed_channel.start()
+
+
+async def stop_latest_feed():
+    await feed_channel.stop()
@@ -0,0 +1,106 @@
+import asyncio
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+from decouple import config
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+
+from .metrics import PASSWORD_HASHING_DURATION, PASSWORD_HASHING_QUEUE_DEPTH,\
+    PASSWORD_HASHING_REJECTED
+
+
+BCRYPT_ROUNDS = config("BCRYPT_ROUNDS", default=12, cast=int)
+PASSWORD_HASHING_EXECUTOR = config("PASSWORD_HASHING_EXECUTOR", default="thread")
+PASSWORD_HASHING_WORKERS = config("PASSWORD_HASHING_WORKERS", default=4, cast=int)
+PASSWORD_HASHING_QUEUE_SIZE = config("PASSWORD_HASHING_QUEUE_SIZE", default=64, cast=int)
+
+# Hashes below the configured cost are reported by needs_update, so raising
+# BCRYPT_ROUNDS upgrades passwords the next time their owners log in.
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto",
+                           bcrypt__default_rounds=BCRYPT_ROUNDS,
+                           bcrypt__min_rounds=BCRYPT_ROUNDS)
+
+
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def _verify_and_update(password: str, hashed_password: str):
+    return pwd_context.verify_and_update(password, hashed_password)
+
+
+class HashingPool:
+    def __init__(self, kind: str, workers: int, queue_size: int):
+        self.kind = kind
+        self.workers = workers
+        self.queue_size = queue_size
+        self.pending = 0
+        self.rejected = 0
+        self._executor: Executor | None = None
+
+    @property
+    def queue_depth(self) -> int:
+        return max(self.pending - self.workers, 0)
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            elif self.kind == "thread":
+                self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                    thread_name_prefix="bcrypt")
+            else:
+                raise ValueError(
+                    f"Unknown PASSWORD_HASHING_EXECUTOR '{self.kind}'")
+        return self._executor
+
+    async def run(self, operation: str, func, *args):
+        if self.pending >= self.workers + self.queue_size:
+            self.rejected += 1
+            PASSWORD_HASHING_REJECTED.inc()
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Server is busy, try again later",
+                headers={"Retry-After": "1"}
+            )
+        self.pending += 1
+        PASSWORD_HASHING_QUEUE_DEPTH.set(self.queue_depth)
+        start = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_executor(), func, *args)
+        finally:
+            self.pending -= 1
+            PASSWORD_HASHING_QUEUE_DEPTH.set(self.queue_depth)
+            PASSWORD_HASHING_DURATION.labels(operation).observe(time.perf_counter() - start)
+
+    def stats(self) -> dict:
+        return {
+            "executor": self.kind,
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "in_flight": min(self.pending, self.workers),
+            "queue_depth": self.queue_depth,
+            "rejected": self.rejected,
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+hashing_pool = HashingPool(PASSWORD_HASHING_EXECUTOR,
+                           PASSWORD_HASHING_WORKERS,
+                           PASSWORD_HASHING_QUEUE_SIZE)
+
+
+async def hash_password(password: str) -> str:
+    return await hashing_pool.run("hash", _hash, password)
+
+
+# Returns (valid, new_hash), new_hash is only set when the stored hash
+# no longer matches the policy and has to be replaced.
+async def verify_and_update_password(password: str, hashed_password: str):
+    return await hashing_pool.run("verify", _verify_and_update, password, hashed_password)
@@ -0,0 +1,64 @@
+import asyncio
+import hashlib
+
+from decouple import config
+from fastapi import Request, Response, status
+
+from .cache import create_cache_backend
+
+
+RESPONSE_CACHE_BACKEND = config("RESPONSE_CACHE_BACKEND", default="memory")
+RESPONSE_CACHE_URL = config("RESPONSE_CACHE_URL", default="redis://localhost:6379/0")
+RESPONSE_CACHE_SIZE = config("RESPONSE_CACHE_SIZE", default=10000, cast=int)
+# With the memory backend a delete only clears the entry of the worker that
+# handled it, the TTL bounds how long other workers may serve it.
+RESPONSE_CACHE_TTL = config("RESPONSE_CACHE_TTL", default=300, cast=float)
+RESPONSE_MAX_AGE = config("RESPONSE_MAX_AGE", default=0, cast=int)
+
+response_cache = create_cache_backend(RESPONSE_CACHE_BACKEND,
+                                      max_size=RESPONSE_CACHE_SIZE,
+                                      ttl=RESPONSE_CACHE_TTL,
+                                      url=RESPONSE_CACHE_URL,
+                                      prefix="response:")
+
+_pending_deletes = set()
+
+
+def make_etag(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+
+def cache_control() -> str:
+    # Clients always revalidate unless a max age is configured, deleted
+    # recommendations then disappear for them immediately.
+    if RESPONSE_MAX_AGE > 0:
+        return f"public, max-age={RESPONSE_MAX_AGE}"
+    return "public, no-cache"
+
+
+def conditional_response(request: Request, body: bytes) -> Response:
+    etag = make_etag(body)
+    headers = {"ETag": etag, "Cache-Control": cache_control()}
+    if etag_matches(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+def delete_later(delay: float, *keys: str):
+    # Deletes the entries again once a lagging read replica caught up, a read
+    # from it in between may have cached the old body again.
+    async def delete():
+        await asyncio.sleep(delay)
+        await response_cache.delete(*keys)
+
+    task = asyncio.create_task(delete())
+    _pending_deletes.add(task)
+    task.add_done_callback(_pending_deletes.discard)
@@ -0,0 +1,129 @@
+import json
+import logging
+import time
+import warnings
+from collections import Counter
+from contextvars import ContextVar
+
+from decouple import config
+from sqlalchemy import event
+from starlette.datastructures import MutableHeaders
+
+
+# off, warn or raise. In warn and raise mode a statement that runs more
+# than SQL_REPEATED_QUERY_THRESHOLD times within one request is reported,
+# which is what an N+1 query pattern looks like.
+SQL_REPEATED_QUERY_MODE = config("SQL_REPEATED_QUERY_MODE", default="off")
+SQL_REPEATED_QUERY_THRESHOLD = config("SQL_REPEATED_QUERY_THRESHOLD", default=10, cast=int)
+
+logger = logging.getLogger("app.sql")
+
+
+class RepeatedQueryError(RuntimeError):
+    pass
+
+
+class RepeatedQueryWarning(UserWarning):
+    pass
+
+
+class QueryStats:
+    __slots__ = ("count", "duration", "statements", "allow_repeated")
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.statements: Counter[str] = Counter()
+        self.allow_repeated = False
+
+    def repeated(self) -> dict[str, int]:
+        return {statement: count for statement, count in self.statements.items()
+                if count > SQL_REPEATED_QUERY_THRESHOLD}
+
+
+_current_stats: ContextVar[QueryStats | None] = ContextVar("query_stats", default=None)
+
+
+def current_query_stats() -> QueryStats | None:
+    return _current_stats.get()
+
+
+def allow_repeated_queries():
+    # For endpoints that run the same statement per batch on purpose.
+    stats = _current_stats.get()
+    if stats is not None:
+        stats.allow_repeated = True
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current_stats.get() is not None:
+        context._query_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current_stats.get()
+    started = getattr(context, "_query_started", None)
+    if stats is None or started is None:
+        return
+    stats.duration += time.perf_counter() - started
+    stats.count += 1
+    # Statements are parameterized, so the SQL text is the shape of
+    # the query.
+    stats.statements[statement] += 1
+    if (SQL_REPEATED_QUERY_MODE == "off" or stats.allow_repeated
+            or stats.statements[statement] != SQL_REPEATED_QUERY_THRESHOLD + 1):
+        return
+    message = (f"Statement executed more than {SQL_REPEATED_QUERY_THRESHOLD} "
+               f"times in one request: {statement}")
+    if SQL_REPEATED_QUERY_MODE == "raise":
+        raise RepeatedQueryError(message)
+    warnings.warn(message, RepeatedQueryWarning)
+
+
+def instrument_engine(engine):
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+class QueryStatsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = QueryStats()
+        token = _current_stats.set(stats)
+        start = time.perf_counter()
+        status_code = None
+
+        async def send_with_timing(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                # Statements run while a streaming body is produced come
+                # after the headers and are only part of the log entry.
+                headers = MutableHeaders(scope=message)
+                headers.append("Server-Timing",
+                               f'db;dur={stats.duration * 1000:.2f};desc="{stats.count} queries", '
+                               f'app;dur={(time.perf_counter() - start) * 1000:.2f}')
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current_stats.reset(token)
+            if logger.isEnabledFor(logging.INFO):
+                route = scope.get("route")
+                logger.info(json.dumps({
+                    "event": "request",
+                    "method": scope["method"],
+                    "route": route.path if route else scope["path"],
+                    "status": status_code,
+                    "duration_ms": round((time.perf_counter() - start) * 1000, 2),
+                    "db_queries": stats.count,
+                    "db_duration_ms": round(stats.duration * 1000, 2),
+                    "repeated_queries": len(stats.repeated()),
+                }))
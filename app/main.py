@@ -1,13 +1,80 @@
-from fastapi import FastAPI
-from .routers import users, recommendations
+from fastapi import FastAPI, Response
+from .auth import token_cache, user_cache
+from .availability import load_taken_names, taken_names
+from .database import dispose_engines, pool_stats, replica_stats, warm_pool
+from .feed import latest_feed, start_latest_feed, stop_latest_feed
+from .hashing import hashing_pool
+from .http_cache import response_cache
+from .instrumentation import QueryStatsMiddleware
+from .metrics import CONTENT_TYPE_LATEST, MetricsMiddleware, mark_process_dead, render_metrics
+from .routers import users, recommendations, tags
+from .serialization import DefaultResponse
 
 
-app = FastAPI()
+app = FastAPI(default_response_class=DefaultResponse)
+
+app.add_middleware(QueryStatsMiddleware)
+app.add_middleware(MetricsMiddleware)
 
 app.include_router(users.router)
 app.include_router(recommendations.router)
+app.include_router(tags.router)
+
+
+@app.on_event("startup")
+async def warm_database_pool():
+    await warm_pool()
+
+
+@app.on_event("startup")
+async def load_availability_filters():
+    await load_taken_names()
+
+
+@app.on_event("startup")
+async def warm_latest_feed():
+    await start_latest_feed()
+
+
+@app.on_event("shutdown")
+async def stop_latest_feed_channel():
+    await stop_latest_feed()
+
+
+@app.on_event("shutdown")
+async def shutdown_hashing_pool():
+    hashing_pool.shutdown()
+
+
+@app.on_event("shutdown")
+async def dispose_database_engine():
+    await dispose_engines()
+
+
+@app.on_event("shutdown")
+async def cleanup_metrics():
+    mark_process_dead()
 
 
 @app.get("/")
 async def root():
     return {"message": "root"}
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok",
+            "database_pool": pool_stats(),
+            "database_replica": replica_stats(),
+            "password_hashing": hashing_pool.stats(),
+            "principal_cache": {"tokens": token_cache.stats(),
+                                "users": user_cache.stats()},
+            "response_cache": response_cache.stats(),
+            "rate_limits": users.rate_limit_stats(),
+            "availability": taken_names.stats(),
+            "latest_feed": latest_feed.stats()}
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    return Response(content=render_metrics(), media_type=CONTENT_TYPE_LATEST)
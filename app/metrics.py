@@ -0,0 +1,116 @@
+import os
+import time
+
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry,
+                               Counter, Gauge, Histogram, generate_latest, multiprocess)
+
+
+# With PROMETHEUS_MULTIPROC_DIR set every worker writes its samples to its own
+# files in that directory and a scrape of any worker aggregates all of them.
+MULTIPROCESS = "PROMETHEUS_MULTIPROC_DIR" in os.environ
+
+REQUESTS = Counter(
+    "http_requests_total", "HTTP requests.",
+    ["method", "route", "status"]
+)
+REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "HTTP request latency.",
+    ["method", "route"],
+    buckets=(.005, .01, .025, .05, .075, .1, .25, .5, .75, 1, 2.5, 5, 10)
+)
+REQUESTS_IN_PROGRESS = Gauge(
+    "http_requests_in_progress", "HTTP requests being handled.",
+    ["method"], multiprocess_mode="livesum"
+)
+
+DB_POOL_CHECKED_OUT = Gauge(
+    "db_pool_checked_out_connections", "Connections checked out of the pool.",
+    multiprocess_mode="livesum"
+)
+DB_POOL_OVERFLOW = Gauge(
+    "db_pool_overflow_connections", "Connections opened above the pool size.",
+    multiprocess_mode="livesum"
+)
+DB_POOL_WAIT = Histogram(
+    "db_pool_checkout_wait_seconds", "Time to get a connection from the pool.",
+    buckets=(.0005, .001, .005, .01, .05, .1, .5, 1, 5, 30)
+)
+DB_POOL_TIMEOUTS = Counter(
+    "db_pool_timeouts_total", "Checkouts that timed out waiting for a connection."
+)
+DB_REPLICA_LAG = Gauge(
+    "db_replica_lag_seconds", "Replication lag of the read replica at the last check.",
+    multiprocess_mode="max"
+)
+DB_REPLICA_FALLBACKS = Counter(
+    "db_replica_fallbacks_total", "Reads sent to the primary because of the replica.",
+    ["reason"]
+)
+
+JWT_DECODE_DURATION = Histogram(
+    "auth_jwt_decode_seconds", "Time to decode and verify an access token.",
+    buckets=(.00005, .0001, .00025, .0005, .001, .0025, .005, .01)
+)
+PASSWORD_HASHING_DURATION = Histogram(
+    "auth_password_hashing_seconds", "Time to hash or verify a password, queueing included.",
+    ["operation"],
+    buckets=(.01, .05, .1, .2, .3, .5, .75, 1, 2.5, 5)
+)
+PASSWORD_HASHING_QUEUE_DEPTH = Gauge(
+    "auth_password_hashing_queue_depth", "Password hashing calls waiting for a worker.",
+    multiprocess_mode="livesum"
+)
+PASSWORD_HASHING_REJECTED = Counter(
+    "auth_password_hashing_rejected_total", "Password hashing calls rejected with 503."
+)
+
+RATE_LIMIT_REJECTED = Counter(
+    "rate_limit_rejected_total", "Requests rejected by a rate or concurrency limit.",
+    ["limit"]
+)
+
+
+def render_metrics() -> bytes:
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+
+def mark_process_dead():
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        status_code = 500
+        start = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        in_progress = REQUESTS_IN_PROGRESS.labels(method)
+        in_progress.inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            in_progress.dec()
+            # The route template keeps label cardinality bounded, paths that
+            # did not match any route share a single label.
+            route = scope.get("route")
+            route = route.path if route else "<unmatched>"
+            REQUEST_DURATION.labels(method, route).observe(time.perf_counter() - start)
+            REQUESTS.labels(method, route, status_code).inc()
@@ -1,4 +1,5 @@
 from datetime import datetime
+from sqlalchemy import Column, ForeignKey, Index, Integer
 from sqlmodel import SQLModel, Field, Relationship
 from .schemas import UserBase, RecommendationBase, TagBase
 
@@ -7,13 +8,23 @@ class User(UserBase, table=True):
     id: int | None = Field(default=None, primary_key=True)
     hashed_password: str
 
+    # Rows are removed by ON DELETE CASCADE, deleting a user does not load
+    # the recommendations.
     recommendations: list["Recommendation"] = Relationship(
-        back_populates="user", sa_relationship_kwargs={"cascade": "delete"})
+        back_populates="user", sa_relationship_kwargs={"cascade": "delete",
+                                                       "passive_deletes": True})
 
 
 class RecommendationTagLink(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_recommendationtaglink_tag_id_recommendation_id",
+              "tag_id", "recommendation_id"),
+    )
+
     recommendation_id: int | None = Field(
-        default=None, foreign_key="recommendation.id", primary_key=True
+        default=None, sa_column=Column(
+            Integer, ForeignKey("recommendation.id", ondelete="CASCADE"), primary_key=True
+        )
     )
     tag_id: int | None = Field(
         default=None, foreign_key="tag.id", primary_key=True
@@ -21,18 +32,75 @@ class RecommendationTagLink(SQLModel, table=True):
 
 
 class Recommendation(RecommendationBase, table=True):
+    __table_args__ = (
+        Index("ix_recommendation_published_id", "published", "id"),
+        Index("ix_recommendation_user_id_published_id",
+              "user_id", "published", "id"),
+        Index("ix_recommendation_type_of_fiction_published_id",
+              "type_of_fiction", "published", "id"),
+    )
+
     id: int | None = Field(default=None, primary_key=True)
-    published: datetime = Field(nullable=True, default=datetime.utcnow())
+    published: datetime = Field(default_factory=datetime.utcnow)
     updated: datetime | None = Field(default=None)
-    user_id: int = Field(foreign_key="user.id")
+    user_id: int = Field(sa_column=Column(
+        Integer, ForeignKey("user.id", ondelete="CASCADE"), nullable=False
+    ))
 
     user: User = Relationship(back_populates="recommendations")
     tags: list["Tag"] = Relationship(back_populates="recommendations",
-                                     link_model=RecommendationTagLink)
+                                     link_model=RecommendationTagLink,
+                                     sa_relationship_kwargs={"passive_deletes": True})
 
 
 class Tag(TagBase, table=True):
+    __table_args__ = (
+        Index("ix_tag_recommendation_count_id", "recommendation_count", "id"),
+    )
+
     id: int | None = Field(default=None, primary_key=True)
+    # Kept up to date in the transactions that add or remove links,
+    # rebuilt by app.commands.reconcile_tag_counts.
+    recommendation_count: int = Field(default=0,
+                                      sa_column_kwargs={"server_default": "0"})
 
     recommendations: list[Recommendation] = Relationship(back_populates="tags",
                                                          link_model=RecommendationTagLink)
+
+
+class RelatedRecommendation(SQLModel, table=True):
+    # Top related recommendations of every recommendation, maintained by
+    # app.related and rebuilt by app.commands.rebuild_related.
+    __table_args__ = (
+        Index("ix_relatedrecommendation_recommendation_id_score_related_id",
+              "recommendation_id", "score", "related_id"),
+        Index("ix_relatedrecommendation_related_id", "related_id"),
+    )
+
+    recommendation_id: int = Field(sa_column=Column(
+        Integer, ForeignKey("recommendation.id", ondelete="CASCADE"), primary_key=True
+    ))
+    related_id: int = Field(sa_column=Column(
+        Integer, ForeignKey("recommendation.id", ondelete="CASCADE"), primary_key=True
+    ))
+    score: float
+
+
+class TypeOfFictionCount(SQLModel, table=True):
+    # Facet counts, kept up to date with the recommendations like
+    # Tag.recommendation_count and rebuilt by app.commands.rebuild_facets.
+    type_of_fiction: str = Field(max_length=255, primary_key=True)
+    recommendation_count: int = Field(default=0)
+
+
+class TagTypeOfFictionCount(SQLModel, table=True):
+    # Recommendations per tag and type_of_fiction, answers both the tags
+    # within a type_of_fiction and the types within a tag.
+    __table_args__ = (
+        Index("ix_tagtypeoffictioncount_type_of_fiction_count",
+              "type_of_fiction", "recommendation_count", "tag_id"),
+    )
+
+    tag_id: int = Field(foreign_key="tag.id", primary_key=True)
+    type_of_fiction: str = Field(max_length=255, primary_key=True)
+    recommendation_count: int = Field(default=0)
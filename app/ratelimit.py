@@ -0,0 +1,224 @@
+import math
+import time
+import uuid
+from abc import ABC, abstractmethod
+
+from decouple import config
+from fastapi import HTTPException, Request, status
+
+from .cache import LRUCache
+from .metrics import RATE_LIMIT_REJECTED
+
+
+RATE_LIMIT_BACKEND = config("RATE_LIMIT_BACKEND", default="memory")
+RATE_LIMIT_URL = config("RATE_LIMIT_URL", default="redis://localhost:6379/0")
+RATE_LIMIT_MAX_KEYS = config("RATE_LIMIT_MAX_KEYS", default=100000, cast=int)
+# Behind a reverse proxy the client address is the first entry of
+# X-Forwarded-For, which can only be trusted when the proxy sets it.
+RATE_LIMIT_TRUST_FORWARDED = config("RATE_LIMIT_TRUST_FORWARDED", default=False, cast=bool)
+# Slots of workers that died while holding them are given back after this.
+CONCURRENCY_LIMIT_TIMEOUT = config("CONCURRENCY_LIMIT_TIMEOUT", default=60, cast=float)
+
+PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+
+
+def parse_rate(rate: str) -> tuple[float, int] | None:
+    # "10/minute" allows bursts of 10 requests and refills one every 6
+    # seconds. An empty value or a count of 0 disables the limit.
+    if not rate.strip():
+        return None
+    count, _, period = rate.partition("/")
+    count = int(count)
+    if count <= 0:
+        return None
+    if period not in PERIODS:
+        raise ValueError(f"Unknown rate limit period in '{rate}'")
+    return count / PERIODS[period], count
+
+
+class RateLimitBackend(ABC):
+    @abstractmethod
+    async def take(self, key: str, rate: float, burst: int) -> float:
+        # Returns 0 when a token was taken, otherwise the seconds until
+        # the next one is available.
+        ...
+
+    @abstractmethod
+    async def acquire(self, key: str, limit: int) -> str | None:
+        ...
+
+    @abstractmethod
+    async def release(self, key: str, slot: str):
+        ...
+
+
+class MemoryRateLimitBackend(RateLimitBackend):
+    # Limits apply per worker.
+    def __init__(self, max_keys: int):
+        self._buckets = LRUCache(max_size=max_keys)
+        self._slots: dict[str, int] = {}
+
+    async def take(self, key: str, rate: float, burst: int) -> float:
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        retry_after = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            retry_after = (1 - tokens) / rate
+        self._buckets.set(key, (tokens, now))
+        return retry_after
+
+    async def acquire(self, key: str, limit: int) -> str | None:
+        if self._slots.get(key, 0) >= limit:
+            return None
+        self._slots[key] = self._slots.get(key, 0) + 1
+        return key
+
+    async def release(self, key: str, slot: str):
+        self._slots[key] -= 1
+
+
+TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local retry_after = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    retry_after = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000))
+return tostring(retry_after)
+"""
+
+# Slots are members of a sorted set scored by when they were taken, so the
+# ones a crashed worker never released expire on their own.
+ACQUIRE_SCRIPT = """
+local limit = tonumber(ARGV[1])
+local timeout = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - timeout)
+if redis.call('ZCARD', KEYS[1]) >= limit then
+    return 0
+end
+redis.call('ZADD', KEYS[1], now, ARGV[3])
+redis.call('PEXPIRE', KEYS[1], math.ceil(timeout * 1000))
+return 1
+"""
+
+
+class RedisRateLimitBackend(RateLimitBackend):
+    # Shared by every worker, the limits apply to the whole deployment.
+    def __init__(self, url: str, prefix: str = "ratelimit:"):
+        try:
+            from redis import asyncio as redis
+        except ImportError:
+            raise RuntimeError("The redis package is required for the redis rate limit backend")
+        self._client = redis.from_url(url)
+        self._take = self._client.register_script(TAKE_SCRIPT)
+        self._acquire = self._client.register_script(ACQUIRE_SCRIPT)
+        self.prefix = prefix
+
+    async def take(self, key: str, rate: float, burst: int) -> float:
+        return float(await self._take(keys=[self.prefix + key], args=[rate, burst]))
+
+    async def acquire(self, key: str, limit: int) -> str | None:
+        slot = uuid.uuid4().hex
+        acquired = await self._acquire(keys=[self.prefix + key],
+                                       args=[limit, CONCURRENCY_LIMIT_TIMEOUT, slot])
+        return slot if acquired else None
+
+    async def release(self, key: str, slot: str):
+        await self._client.zrem(self.prefix + key, slot)
+
+
+def create_rate_limit_backend(backend: str, *, max_keys: int,
+                              url: str | None = None) -> RateLimitBackend:
+    if backend == "memory":
+        return MemoryRateLimitBackend(max_keys=max_keys)
+    if backend == "redis":
+        return RedisRateLimitBackend(url)
+    raise ValueError(f"Unknown rate limit backend '{backend}'")
+
+
+rate_limit_backend = create_rate_limit_backend(RATE_LIMIT_BACKEND,
+                                               max_keys=RATE_LIMIT_MAX_KEYS,
+                                               url=RATE_LIMIT_URL)
+
+
+def client_ip(request: Request) -> str:
+    if RATE_LIMIT_TRUST_FORWARDED:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+
+class RateLimit:
+    # Token bucket, used as a dependency it is keyed by client address,
+    # hit() takes any other key.
+    def __init__(self, name: str, rate: str):
+        self.name = name
+        self.rate = parse_rate(rate)
+        self.rejected = 0
+
+    async def hit(self, key: str):
+        if self.rate is None:
+            return
+        rate, burst = self.rate
+        retry_after = await rate_limit_backend.take(f"{self.name}:{key}", rate, burst)
+        if retry_after > 0:
+            self.rejected += 1
+            RATE_LIMIT_REJECTED.labels(self.name).inc()
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many requests, try again later",
+                headers={"Retry-After": str(math.ceil(retry_after))}
+            )
+
+    async def __call__(self, request: Request):
+        await self.hit(client_ip(request))
+
+    def stats(self) -> dict:
+        return {"rate": self.rate, "rejected": self.rejected}
+
+
+class ConcurrencyLimit:
+    # Rejects requests beyond `limit` in flight instead of queueing them,
+    # so a flood of expensive requests fails fast and leaves the worker
+    # to everything else.
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = limit
+        self.rejected = 0
+
+    async def __call__(self):
+        if self.limit <= 0:
+            yield
+            return
+        slot = await rate_limit_backend.acquire(self.name, self.limit)
+        if slot is None:
+            self.rejected += 1
+            RATE_LIMIT_REJECTED.labels(self.name).inc()
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Server is busy, try again later",
+                headers={"Retry-After": "1"}
+            )
+        try:
+            yield
+        finally:
+            await rate_limit_backend.release(self.name, slot)
+
+    def stats(self) -> dict:
+        return {"limit": self.limit, "rejected": self.rejected}
@@ -0,0 +1,168 @@
+import asyncio
+import heapq
+import math
+from collections import defaultdict
+
+from decouple import config
+from sqlalchemy import bindparam, case, delete, exc, func, insert
+from sqlalchemy.orm import aliased, selectinload
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from .cache import LRUCache
+from .database import async_session
+from .models import Tag, Recommendation, RecommendationTagLink, RelatedRecommendation
+
+
+# Two recommendations are scored by the IDF weights of the tags they share,
+# every recommendation keeps its RELATED_TOP_K best matches in the
+# relatedrecommendation table.
+RELATED_TOP_K = config("RELATED_TOP_K", default=20, cast=int)
+# Tags on more recommendations than this say little about similarity and
+# would make a large part of the table a candidate, they are left out of
+# the score like stop words.
+RELATED_MAX_TAG_RECOMMENDATIONS = config("RELATED_MAX_TAG_RECOMMENDATIONS",
+                                         default=5000, cast=int)
+# Bulk imports leave the table to a background task that scores this many
+# new recommendations per transaction.
+RELATED_REFRESH_CHUNK_SIZE = config("RELATED_REFRESH_CHUNK_SIZE", default=100, cast=int)
+
+# Counting the recommendations would scan the table, the highest id is read
+# from the primary key instead. The logarithm in the IDF makes the rows
+# deleted since, and a total that is a few minutes old, irrelevant.
+recommendation_total_cache = LRUCache(max_size=1, ttl=300)
+
+_pending_refreshes = set()
+
+
+def idf(total: int, count: int) -> float:
+    return math.log(max(total, count, 1) / max(count, 1))
+
+
+def top_related(scores: dict[int, float], k: int = RELATED_TOP_K) -> list[tuple[int, float]]:
+    # Ties go to the newer recommendation.
+    return heapq.nlargest(k, scores.items(), key=lambda item: (item[1], item[0]))
+
+
+async def estimate_recommendation_total(session: AsyncSession) -> int:
+    total = recommendation_total_cache.get("total")
+    if total is None:
+        result = await session.execute(select(func.max(Recommendation.id)))
+        total = result.scalar() or 0
+        recommendation_total_cache.set("total", total)
+    return total
+
+
+async def get_related_recommendations(session: AsyncSession, recommendation_id: int,
+                                      limit: int = RELATED_TOP_K):
+    result = await session.exec(
+        select(Recommendation).
+        join(RelatedRecommendation, RelatedRecommendation.related_id == Recommendation.id).
+        where(RelatedRecommendation.recommendation_id == recommendation_id).
+        order_by(RelatedRecommendation.score.desc(), RelatedRecommendation.related_id.desc()).
+        limit(limit).
+        options(selectinload(Recommendation.tags))
+    )
+    return result.all()
+
+
+async def update_related(session: AsyncSession, recommendation_ids: list[int]):
+    # Called after new recommendations and their links were flushed (and
+    # the tag counts updated), in the same transaction.
+    new = set(recommendation_ids)
+    total = await estimate_recommendation_total(session)
+    result = await session.execute(
+        select(Tag.id, Tag.recommendation_count).distinct().
+        join(RecommendationTagLink, RecommendationTagLink.tag_id == Tag.id).
+        where(RecommendationTagLink.recommendation_id.in_(new),
+              Tag.recommendation_count <= RELATED_MAX_TAG_RECOMMENDATIONS)
+    )
+    weights = {tag_id: idf(total, count) for tag_id, count in result}
+    if not weights:
+        return
+
+    # Candidates are everything sharing a weighted tag, summed and ranked
+    # by the database, only the best RELATED_TOP_K of each come back.
+    link = aliased(RecommendationTagLink)
+    shared = aliased(RecommendationTagLink)
+    summed = func.sum(case(weights, value=link.tag_id))
+    ranked = select(
+        link.recommendation_id.label("recommendation_id"),
+        shared.recommendation_id.label("related_id"),
+        summed.label("score"),
+        func.row_number().over(
+            partition_by=link.recommendation_id,
+            order_by=(summed.desc(), shared.recommendation_id.desc())
+        ).label("rank")
+    ).join(shared, shared.tag_id == link.tag_id).\
+        where(link.recommendation_id.in_(new),
+              link.tag_id.in_(weights),
+              shared.recommendation_id != link.recommendation_id).\
+        group_by(link.recommendation_id, shared.recommendation_id).\
+        subquery()
+    result = await session.execute(
+        select(ranked.c.recommendation_id, ranked.c.related_id, ranked.c.score).
+        where(ranked.c.rank <= RELATED_TOP_K).
+        order_by(ranked.c.recommendation_id, ranked.c.rank)
+    )
+    lists = {recommendation_id: [] for recommendation_id in new}
+    for recommendation_id, related_id, score in result:
+        lists[recommendation_id].append((related_id, score))
+
+    # A new recommendation may also belong among the best matches of the
+    # recommendations it matches.
+    neighbours = {other for related in lists.values() for other, _ in related} - new
+    original = defaultdict(dict)
+    if neighbours:
+        result = await session.execute(
+            select(RelatedRecommendation.recommendation_id, RelatedRecommendation.related_id,
+                   RelatedRecommendation.score).
+            where(RelatedRecommendation.recommendation_id.in_(neighbours))
+        )
+        for recommendation_id, related_id, score in result:
+            original[recommendation_id][related_id] = score
+    updated = {neighbour: dict(original[neighbour]) for neighbour in neighbours}
+    for recommendation_id, related in lists.items():
+        for other, score in related:
+            if other in updated:
+                updated[other][recommendation_id] = score
+
+    inserts = [{"recommendation_id": recommendation_id, "related_id": other, "score": score}
+               for recommendation_id, related in lists.items() for other, score in related]
+    deletes = []
+    for neighbour, scores in updated.items():
+        kept = dict(top_related(scores))
+        inserts.extend({"recommendation_id": neighbour, "related_id": other, "score": score}
+                       for other, score in kept.items() if other not in original[neighbour])
+        deletes.extend({"source_id": neighbour, "target_id": other}
+                       for other in original[neighbour] if other not in kept)
+
+    related = RelatedRecommendation.__table__
+    if deletes:
+        await session.execute(
+            delete(related).where(related.c.recommendation_id == bindparam("source_id"),
+                                  related.c.related_id == bindparam("target_id")),
+            deletes
+        )
+    if inserts:
+        await session.execute(insert(related), inserts)
+
+
+async def refresh_related(recommendation_ids: list[int]):
+    async with async_session() as session:
+        for start in range(0, len(recommendation_ids), RELATED_REFRESH_CHUNK_SIZE):
+            try:
+                await update_related(
+                    session=session,
+                    recommendation_ids=recommendation_ids[start:start + RELATED_REFRESH_CHUNK_SIZE]
+                )
+                await session.commit()
+            except exc.SQLAlchemyError:
+                # Those are picked up by the next rebuild_related run.
+                await session.rollback()
+
+
+def refresh_related_later(recommendation_ids: list[int]):
+    task = asyncio.create_task(refresh_related(recommendation_ids))
+    _pending_refreshes.add(task)
+    task.add_done_callback(_pending_refreshes.discard)
@@ -1,27 +1,143 @@
-from typing import Annotated
+import csv
+import io
+import json
+from typing import Annotated, Literal
 
-from fastapi import APIRouter, Depends, Body, Path, HTTPException, status
-from sqlmodel import Session, select
+from fastapi import APIRouter, Depends, Body, Path, Query, HTTPException, Request, Response,\
+    status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from decouple import config
+from pydantic import ValidationError
+from sqlalchemy.exc import SQLAlchemyError
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from ..auth import get_current_user
-from ..database import get_session
-from ..schemas import RecommendationCreate, RecommendationRead
+from ..database import get_read_session, get_write_session, read_session,\
+    reads_from_primary, replica_engine, DATABASE_REPLICA_MAX_LAG
+from ..schemas import RecommendationCreate, RecommendationRead, RecommendationPage,\
+    RecommendationSearchPage, BulkImportItem, BulkImportResult, FacetCount, Facets
 from ..models import User, Recommendation, Tag
-from ..crud import save_tags, get_recommendation_by_id
+from ..crud import save_tags, get_recommendation_by_id, get_recommendations_by_ids,\
+    get_tag_id, list_recommendations, search_recommendations, iter_user_recommendations,\
+    normalize_tag_name, resolve_tag_ids, insert_recommendations, update_recommendation_counts,\
+    get_type_of_fiction_counts, get_tag_counts
+from ..pagination import encode_cursor, decode_cursor
+from ..http_cache import response_cache, conditional_response, delete_later
+from ..serialization import fast_response, serialize_recommendation, serialize_ndjson
+from ..instrumentation import allow_repeated_queries
+from ..related import get_related_recommendations, update_related, refresh_related_later,\
+    RELATED_TOP_K
+from ..feed import latest_feed, publish_added, publish_removed, publish_reload,\
+    LATEST_FEED_PAGE_SIZE
 
 
 router = APIRouter(
     tags=['recommendations'],
 )
 
+MAX_BATCH_IDS = 300
+MAX_SEARCH_OFFSET = 1000
+MAX_FACET_VALUES = 100
+BULK_IMPORT_MAX_ITEMS = config("BULK_IMPORT_MAX_ITEMS", default=10000, cast=int)
+BULK_IMPORT_CHUNK_SIZE = config("BULK_IMPORT_CHUNK_SIZE", default=500, cast=int)
+TAG_RESOLVE_CHUNK_SIZE = 1000
+
+
+def recommendation_cache_key(recommendation_id: int) -> str:
+    return f"recommendation:{recommendation_id}"
+
+
+EXPORT_CSV_COLUMNS = ["id", "type_of_fiction", "title", "short_description",
+                      "opinion", "published", "updated", "tags"]
+
+
+async def export_ndjson(user_id: int, use_primary: bool):
+    async with read_session(use_primary=use_primary) as session:
+        async for batch in iter_user_recommendations(session=session, user_id=user_id):
+            yield serialize_ndjson(batch)
+
+
+async def export_csv(user_id: int, use_primary: bool):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_CSV_COLUMNS)
+    writer.writeheader()
+    # Sent on its own, a user without recommendations still gets it.
+    yield buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    async with read_session(use_primary=use_primary) as session:
+        async for batch in iter_user_recommendations(session=session, user_id=user_id):
+            for row in batch:
+                row["tags"] = " ".join(tag["name"] for tag in row["tags"])
+                writer.writerow(jsonable_encoder(row))
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+
+async def read_bulk_items(request: Request) -> list:
+    body = await request.body()
+    if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+        items = []
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError as e:
+                items.append(e)
+    else:
+        try:
+            items = json.loads(body)
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Body must be a JSON array or newline delimited JSON"
+            )
+        if not isinstance(items, list):
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail="Body must be a JSON array"
+            )
+    if len(items) > BULK_IMPORT_MAX_ITEMS:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"At most {BULK_IMPORT_MAX_ITEMS} recommendations can be imported at once"
+        )
+    return items
+
+
+def validation_error_message(error: ValidationError) -> str:
+    return "; ".join(f"{'.'.join(map(str, e['loc']))}: {e['msg']}"
+                     for e in error.errors())
+
+
+def parse_ids(ids: str) -> list[int]:
+    try:
+        parsed = [int(id) for id in ids.split(',') if id.strip()]
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="ids must be a comma separated list of integers"
+        )
+    parsed = list(dict.fromkeys(parsed))
+    if len(parsed) > MAX_BATCH_IDS:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"At most {MAX_BATCH_IDS} ids can be requested at once"
+        )
+    return parsed
+
 
 @router.post('/recommend',
              response_model=RecommendationRead,
              status_code=status.HTTP_201_CREATED)
 async def post_recommendation(data: Annotated[RecommendationCreate, Body()],
                               current_user: Annotated[User, Depends(get_current_user)],
-                              session: Annotated[Session, Depends(get_session)]):
-    tags = save_tags(session=session, tags=data.tags)
+                              session: Annotated[AsyncSession, Depends(get_write_session)],
+                              response: Response):
+    tags = await save_tags(session=session, tags=data.tags)
     recommendation = Recommendation(
         type_of_fiction=data.type_of_fiction,
         title=data.title,
@@ -31,32 +147,243 @@ async def post_recommendation(data: Annotated[RecommendationCreate, Body()],
         user_id=current_user.id
     )
     session.add(recommendation)
-    session.commit()
-    session.refresh(recommendation)
-    return recommendation
+    await update_recommendation_counts(session=session,
+                                       type_of_fiction=data.type_of_fiction,
+                                       tag_ids=[tag.id for tag in tags], delta=1)
+    await session.flush()
+    await update_related(session=session, recommendation_ids=[recommendation.id])
+    await publish_added(session=session, recommendation=recommendation)
+    await session.commit()
+    return fast_response(recommendation, response, status_code=status.HTTP_201_CREATED)
+
+
+@router.post('/recommend/bulk',
+             response_model=BulkImportResult,
+             openapi_extra={"requestBody": {"required": True, "content": {
+                 "application/json": {"schema": {
+                     "type": "array",
+                     "items": {"$ref": "#/components/schemas/RecommendationCreate"}
+                 }},
+                 "application/x-ndjson": {"schema": {"type": "string"}},
+             }}})
+async def post_recommendations_bulk(request: Request,
+                                    current_user: Annotated[User, Depends(get_current_user)],
+                                    session: Annotated[AsyncSession, Depends(get_write_session)]):
+    # Every chunk runs the same statements.
+    allow_repeated_queries()
+    results = []
+    valid: list[tuple[int, RecommendationCreate]] = []
+    for index, item in enumerate(await read_bulk_items(request)):
+        if isinstance(item, ValueError):
+            results.append(BulkImportItem(index=index, error=f"Invalid JSON: {item}"))
+            continue
+        try:
+            valid.append((index, RecommendationCreate.parse_obj(item)))
+        except ValidationError as e:
+            results.append(BulkImportItem(index=index,
+                                          error=validation_error_message(e)))
+
+    # Tags of every item are resolved once, up front, and committed so that
+    # a failing chunk does not roll them back for the following ones.
+    names = list(dict.fromkeys(normalize_tag_name(tag)
+                               for _, item in valid for tag in item.tags))
+    tag_ids = {}
+    for start in range(0, len(names), TAG_RESOLVE_CHUNK_SIZE):
+        tag_ids.update(await resolve_tag_ids(
+            session=session, names=names[start:start + TAG_RESOLVE_CHUNK_SIZE]
+        ))
+    await session.commit()
+
+    for start in range(0, len(valid), BULK_IMPORT_CHUNK_SIZE):
+        chunk = valid[start:start + BULK_IMPORT_CHUNK_SIZE]
+        try:
+            ids = await insert_recommendations(session=session,
+                                               user_id=current_user.id,
+                                               items=[item for _, item in chunk],
+                                               tag_ids=tag_ids)
+            await session.commit()
+        except SQLAlchemyError:
+            await session.rollback()
+            results.extend(BulkImportItem(index=index, error="Could not be saved")
+                           for index, _ in chunk)
+            continue
+        results.extend(BulkImportItem(index=index, id=id)
+                       for (index, _), id in zip(chunk, ids))
+
+    results.sort(key=lambda result: result.index)
+    created = sum(result.id is not None for result in results)
+    if created:
+        # One reload instead of a message per recommendation.
+        await publish_reload(session=session)
+        await session.commit()
+        # Scoring related recommendations costs more than the import
+        # itself, they show up once the background task got to them.
+        refresh_related_later([result.id for result in results if result.id is not None])
+    return BulkImportResult(created=created,
+                            failed=len(results) - created,
+                            items=results)
+
+
+@router.get('/recommendations',
+            response_model=RecommendationPage)
+async def get_recommendations(session: Annotated[AsyncSession, Depends(get_read_session)],
+                              response: Response,
+                              ids: Annotated[str | None, Query()] = None,
+                              user_id: Annotated[int | None, Query()] = None,
+                              tag: Annotated[str | None, Query()] = None,
+                              type_of_fiction: Annotated[str | None, Query()] = None,
+                              cursor: Annotated[str | None, Query()] = None,
+                              limit: Annotated[int, Query(ge=1, le=100)] = 20):
+    if ids is not None:
+        recommendations = await get_recommendations_by_ids(
+            session=session, recommendation_ids=parse_ids(ids)
+        )
+        return fast_response({"items": recommendations, "next_cursor": None}, response)
+    after = decode_cursor(cursor) if cursor else None
+    tag_id = None
+    if tag is not None:
+        tag_id = await get_tag_id(session=session, name=tag)
+        if tag_id is None:
+            return RecommendationPage(items=[])
+    recommendations = await list_recommendations(session=session,
+                                                 limit=limit + 1,
+                                                 after=after,
+                                                 user_id=user_id,
+                                                 tag_id=tag_id,
+                                                 type_of_fiction=type_of_fiction)
+    next_cursor = None
+    if len(recommendations) > limit:
+        recommendations = recommendations[:limit]
+        last = recommendations[-1]
+        next_cursor = encode_cursor(last.published, last.id)
+    return fast_response({"items": recommendations, "next_cursor": next_cursor}, response)
+
+
+@router.get('/recommendations/search',
+            response_model=RecommendationSearchPage)
+async def search(session: Annotated[AsyncSession, Depends(get_read_session)],
+                 response: Response,
+                 q: Annotated[str, Query(min_length=1, max_length=255)],
+                 tag: Annotated[str | None, Query()] = None,
+                 type_of_fiction: Annotated[str | None, Query()] = None,
+                 offset: Annotated[int, Query(ge=0, le=MAX_SEARCH_OFFSET)] = 0,
+                 limit: Annotated[int, Query(ge=1, le=100)] = 20):
+    tag_id = None
+    if tag is not None:
+        tag_id = await get_tag_id(session=session, name=tag)
+        if tag_id is None:
+            return RecommendationSearchPage(items=[])
+    recommendations = await search_recommendations(session=session,
+                                                   query=q,
+                                                   limit=limit + 1,
+                                                   offset=offset,
+                                                   tag_id=tag_id,
+                                                   type_of_fiction=type_of_fiction)
+    next_offset = None
+    if len(recommendations) > limit:
+        recommendations = recommendations[:limit]
+        if offset + limit <= MAX_SEARCH_OFFSET:
+            next_offset = offset + limit
+    return fast_response({"items": recommendations, "next_offset": next_offset}, response)
+
+
+@router.get('/users/{user_id}/recommendations/export',
+            response_class=StreamingResponse)
+async def export_recommendations(user_id: Annotated[int, Path()],
+                                 request: Request,
+                                 session: Annotated[AsyncSession, Depends(get_read_session)],
+                                 format: Annotated[Literal["ndjson", "csv"], Query()] = "ndjson"):
+    if not await session.get(User, user_id):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"User with id {user_id} was not found"
+        )
+    # The rows are read in the generator with a session of its own, it
+    # outlives the request handler.
+    use_primary = reads_from_primary(request)
+    if format == "csv":
+        return StreamingResponse(export_csv(user_id, use_primary), media_type="text/csv",
+                                 headers={"Content-Disposition":
+                                          f'attachment; filename="recommendations-{user_id}.csv"'})
+    return StreamingResponse(export_ndjson(user_id, use_primary),
+                             media_type="application/x-ndjson")
+
+
+@router.get('/recommendations/facets',
+            response_model=Facets)
+async def get_facets(session: Annotated[AsyncSession, Depends(get_read_session)],
+                     tag: Annotated[str | None, Query()] = None,
+                     type_of_fiction: Annotated[str | None, Query()] = None,
+                     limit: Annotated[int, Query(ge=1, le=MAX_FACET_VALUES)] = 20):
+    # Read from the count tables. Each facet is narrowed by the other one,
+    # so a picked value still shows its alternatives.
+    if tag is not None:
+        tag_id = await get_tag_id(session=session, name=tag)
+        types = await get_type_of_fiction_counts(session=session, limit=limit,
+                                                 tag_id=tag_id) if tag_id else []
+    else:
+        types = await get_type_of_fiction_counts(session=session, limit=limit)
+    tags = await get_tag_counts(session=session, limit=limit, type_of_fiction=type_of_fiction)
+    return Facets(type_of_fiction=[FacetCount(value=value, count=count) for value, count in types],
+                  tags=[FacetCount(value=value, count=count) for value, count in tags])
+
+
+@router.get('/recommendations/latest',
+            response_model=list[RecommendationRead],
+            responses={status.HTTP_304_NOT_MODIFIED: {"description": "Not modified"}})
+async def get_latest_recommendations(
+    request: Request,
+    limit: Annotated[int, Query(ge=1, le=LATEST_FEED_PAGE_SIZE)] = 20
+):
+    # Served from the in-process buffer, no database access.
+    return conditional_response(request, await latest_feed.page(limit))
 
 
 @router.get('/recommendations/{recommendation_id}',
-            response_model=RecommendationRead)
+            response_model=RecommendationRead,
+            responses={status.HTTP_304_NOT_MODIFIED: {"description": "Not modified"}})
 async def get_recommendation(recommendation_id: Annotated[int, Path()],
-                             session: Annotated[Session, Depends(get_session)]):
-    recommendation = get_recommendation_by_id(session=session,
-                                              recommendation_id=recommendation_id)
-    if not recommendation:
+                             request: Request,
+                             session: Annotated[AsyncSession, Depends(get_read_session)]):
+    cache_key = recommendation_cache_key(recommendation_id)
+    body = await response_cache.get(cache_key)
+    if body is None:
+        recommendation = await get_recommendation_by_id(session=session,
+                                                        recommendation_id=recommendation_id)
+        if not recommendation:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Recommendation with id {recommendation_id} was not found"
+            )
+        body = serialize_recommendation(recommendation)
+        await response_cache.set(cache_key, body)
+    return conditional_response(request, body)
+
+
+@router.get('/recommendations/{recommendation_id}/related',
+            response_model=list[RecommendationRead])
+async def get_related(recommendation_id: Annotated[int, Path()],
+                      session: Annotated[AsyncSession, Depends(get_read_session)],
+                      response: Response,
+                      limit: Annotated[int, Query(ge=1, le=RELATED_TOP_K)] = 10):
+    recommendations = await get_related_recommendations(session=session,
+                                                        recommendation_id=recommendation_id,
+                                                        limit=limit)
+    if not recommendations and not await session.get(Recommendation, recommendation_id):
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Recommendation with id {recommendation_id} was not found"
         )
-    return recommendation
+    return fast_response(recommendations, response)
 
 
 @router.delete('/recommendations/{recommendation_id}',
                status_code=status.HTTP_204_NO_CONTENT)
 async def delete_recommendation(recommendation_id: Annotated[int, Path()],
-                                session: Annotated[Session, Depends(get_session)],
+                                session: Annotated[AsyncSession, Depends(get_write_session)],
                                 current_user: Annotated[User, Depends(get_current_user)]):
-    recommendation = get_recommendation_by_id(session=session,
-                                              recommendation_id=recommendation_id)
+    recommendation = await get_recommendation_by_id(session=session,
+                                                    recommendation_id=recommendation_id)
     if not recommendation:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -67,5 +394,14 @@ async def delete_recommendation(recommendation_id: Annotated[int, Path()],
             status_code=status.HTTP_403_FORBIDDEN,
             detail=f"You have not permission to delete this recommendation"
         )
-    session.delete(recommendation)
-    session.commit()
+    await update_recommendation_counts(session=session,
+                                       type_of_fiction=recommendation.type_of_fiction,
+                                       tag_ids=[tag.id for tag in recommendation.tags],
+                                       delta=-1)
+    await session.delete(recommendation)
+    await publish_removed(session=session, recommendation_id=recommendation_id)
+    await session.commit()
+    cache_key = recommendation_cache_key(recommendation_id)
+    await response_cache.delete(cache_key)
+    if replica_engine is not None:
+        delete_later(DATABASE_REPLICA_MAX_LAG, cache_key)
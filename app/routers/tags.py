@@ -0,0 +1,58 @@
+import asyncio
+from typing import Annotated
+
+from fastapi import APIRouter, Depends, Path, Query, HTTPException, status
+from decouple import config
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from ..cache import LRUCache
+from ..database import get_read_session
+from ..schemas import TagCountRead
+from ..crud import get_popular_tags, get_tag_with_name
+
+
+router = APIRouter(
+    tags=['tags'],
+    prefix='/tags'
+)
+
+MAX_POPULAR_TAGS = 100
+# The top tags are read at most once per interval and worker, counts
+# served in between may be that much behind.
+POPULAR_TAGS_REFRESH_SECONDS = config("POPULAR_TAGS_REFRESH_SECONDS", default=60, cast=float)
+
+popular_tags_cache = LRUCache(max_size=1, ttl=POPULAR_TAGS_REFRESH_SECONDS)
+popular_tags_lock = asyncio.Lock()
+
+
+async def load_popular_tags(session: AsyncSession) -> list[TagCountRead]:
+    tags = popular_tags_cache.get("popular")
+    if tags is not None:
+        return tags
+    # Requests arriving while the list is refreshed wait for that single
+    # query instead of running their own.
+    async with popular_tags_lock:
+        tags = popular_tags_cache.get("popular")
+        if tags is None:
+            tags = [TagCountRead.from_orm(tag) for tag in
+                    await get_popular_tags(session=session, limit=MAX_POPULAR_TAGS)]
+            popular_tags_cache.set("popular", tags)
+    return tags
+
+
+@router.get('/popular', response_model=list[TagCountRead])
+async def popular_tags(session: Annotated[AsyncSession, Depends(get_read_session)],
+                       limit: Annotated[int, Query(ge=1, le=MAX_POPULAR_TAGS)] = 20):
+    return (await load_popular_tags(session))[:limit]
+
+
+@router.get('/{tag_name}', response_model=TagCountRead)
+async def get_tag(tag_name: Annotated[str, Path()],
+                  session: Annotated[AsyncSession, Depends(get_read_session)]):
+    tag = await get_tag_with_name(session=session, name=tag_name)
+    if not tag:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Tag {tag_name} was not found"
+        )
+    return tag
@@ -2,16 +2,25 @@ import re
 from datetime import timedelta
 from typing import Annotated
 
-from fastapi import APIRouter, Depends, Body, HTTPException, status
+from fastapi import APIRouter, Depends, Body, HTTPException, Query, status
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlmodel import Session, select
+from decouple import config
+from sqlalchemy import delete
+from sqlalchemy.exc import IntegrityError
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from ..auth import create_access_token, get_current_user, authenticate_user, Token,\
-    ACCESS_TOKEN_EXPIRES_HOURS, get_password_hash
-from ..database import get_session
+    ACCESS_TOKEN_EXPIRES_HOURS, get_password_hash, invalidate_user
+from ..database import get_read_session, get_write_session, replica_engine, DATABASE_REPLICA_MAX_LAG
 from ..schemas import UserCreate, UserRead, UserUpdate
 from ..models import User
-from ..crud import get_user_with_username, get_user_with_email
+from ..crud import delete_user_recommendations
+from ..availability import taken_names
+from ..feed import publish_reload
+from ..ratelimit import RateLimit, ConcurrencyLimit
+from ..http_cache import response_cache, delete_later
+from ..instrumentation import allow_repeated_queries
+from .recommendations import recommendation_cache_key
 
 
 router = APIRouter(
@@ -19,38 +28,98 @@ router = APIRouter(
     prefix='/auth'
 )
 
+# Both endpoints hash a password. Rates are "<count>/<second|minute|hour|day>",
+# an empty value or a limit of 0 turns a limit off.
+TOKEN_RATE_LIMIT_PER_IP = config("TOKEN_RATE_LIMIT_PER_IP", default="60/minute")
+TOKEN_RATE_LIMIT_PER_USERNAME = config("TOKEN_RATE_LIMIT_PER_USERNAME", default="10/minute")
+TOKEN_CONCURRENCY_LIMIT = config("TOKEN_CONCURRENCY_LIMIT", default=16, cast=int)
+REGISTER_RATE_LIMIT_PER_IP = config("REGISTER_RATE_LIMIT_PER_IP", default="20/hour")
+REGISTER_CONCURRENCY_LIMIT = config("REGISTER_CONCURRENCY_LIMIT", default=8, cast=int)
+AVAILABILITY_RATE_LIMIT_PER_IP = config("AVAILABILITY_RATE_LIMIT_PER_IP", default="120/minute")
+# Recommendations of a deleted account are removed this many per
+# transaction, so no transaction holds its locks for long.
+ACCOUNT_DELETE_BATCH_SIZE = config("ACCOUNT_DELETE_BATCH_SIZE", default=1000, cast=int)
 
-@router.post("/register", response_model=UserRead)
-async def register(*, session: Annotated[Session, Depends(get_session)],
-                   data: Annotated[UserCreate, Body()]):
-    if get_user_with_username(session=session, username=data.username):
-        raise HTTPException(
-            status_code=status.HTTP_409_CONFLICT,
-            detail="Duplicate username"
-        )
-    if get_user_with_email(session=session, email=data.email):
+token_ip_limit = RateLimit("token_ip", TOKEN_RATE_LIMIT_PER_IP)
+token_username_limit = RateLimit("token_username", TOKEN_RATE_LIMIT_PER_USERNAME)
+token_concurrency_limit = ConcurrencyLimit("token", TOKEN_CONCURRENCY_LIMIT)
+register_ip_limit = RateLimit("register_ip", REGISTER_RATE_LIMIT_PER_IP)
+register_concurrency_limit = ConcurrencyLimit("register", REGISTER_CONCURRENCY_LIMIT)
+availability_ip_limit = RateLimit("availability_ip", AVAILABILITY_RATE_LIMIT_PER_IP)
+
+# Unique indexes of the user table and the field each one guards.
+USER_UNIQUE_INDEXES = {"ix_user_username": "username", "ix_user_email": "email"}
+
+
+async def limit_token_username(form_data: Annotated[OAuth2PasswordRequestForm, Depends()]):
+    # Slows down guessing the password of a single account from many
+    # addresses.
+    await token_username_limit.hit(form_data.username.lower())
+
+
+def rate_limit_stats() -> dict:
+    return {limit.name: limit.stats() for limit in
+            (token_ip_limit, token_username_limit, token_concurrency_limit,
+             register_ip_limit, register_concurrency_limit, availability_ip_limit)}
+
+
+def duplicate_user_field(error: IntegrityError) -> str | None:
+    # asyncpg errors are wrapped by the SQLAlchemy adapter, psycopg2 ones
+    # carry the constraint name themselves.
+    violation = error.orig.__cause__ or error.orig
+    diag = getattr(violation, "diag", None)
+    constraint = getattr(violation, "constraint_name", None) or\
+        getattr(diag, "constraint_name", None)
+    if constraint:
+        return USER_UNIQUE_INDEXES.get(constraint)
+    # SQLite names the column, "UNIQUE constraint failed: user.email".
+    match = re.search(r"UNIQUE constraint failed: user\.(\w+)", str(error.orig))
+    return match.group(1) if match else None
+
+
+async def commit_user(session: AsyncSession):
+    # The unique indexes decide, looking the username and email up first
+    # would cost two more round trips and still race with a concurrent
+    # request.
+    try:
+        await session.commit()
+    except IntegrityError as error:
+        await session.rollback()
+        field = duplicate_user_field(error)
+        if field is None:
+            raise
         raise HTTPException(
             status_code=status.HTTP_409_CONFLICT,
-            detail="Duplicate email"
+            detail=f"Duplicate {field}"
         )
-    hashed_password = get_password_hash(data.password)
+
+
+@router.post("/register", response_model=UserRead,
+             dependencies=[Depends(register_ip_limit),
+                           Depends(register_concurrency_limit)])
+async def register(*, session: Annotated[AsyncSession, Depends(get_write_session)],
+                   data: Annotated[UserCreate, Body()]):
+    hashed_password = await get_password_hash(data.password)
     new_user = User(username=data.username,
                     email=data.email,
                     hashed_password=hashed_password)
     session.add(new_user)
-    session.commit()
-    session.refresh(new_user)
+    await commit_user(session)
+    taken_names.add(new_user.username, new_user.email)
     return new_user
 
 
-@router.post("/token", response_model=Token)
+@router.post("/token", response_model=Token,
+             dependencies=[Depends(token_ip_limit),
+                           Depends(limit_token_username),
+                           Depends(token_concurrency_limit)])
 async def login_for_access_token(
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
-    session: Annotated[Session, Depends(get_session)]
+    session: Annotated[AsyncSession, Depends(get_write_session)]
 ):
-    user = authenticate_user(session=session,
-                             username=form_data.username,
-                             password=form_data.password)
+    user = await authenticate_user(session=session,
+                                   username=form_data.username,
+                                   password=form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -77,36 +146,66 @@ async def read_users_me(
 async def update_user(
     data: Annotated[UserUpdate, Body()],
     current_user: Annotated[User, Depends(get_current_user)],
-    session: Annotated[Session, Depends(get_session)]
+    session: Annotated[AsyncSession, Depends(get_write_session)]
 ):
     data: dict = data.dict(exclude_unset=True)
     if not data:
         return current_user
-    else:
-        new_username = data.get('username')
-        if new_username:
-            user_with_username = get_user_with_username(
-                session=session, username=new_username
-            )
-            if user_with_username and (user_with_username.id != current_user.id):
-                raise HTTPException(
-                    status_code=status.HTTP_409_CONFLICT,
-                    detail='Duplicate username'
-                )
-            current_user.username = new_username
-        new_email = data.get('email')
-        if new_email:
-            user_with_email = get_user_with_email(
-                session=session, email=new_email
-            )
-            if user_with_email and (user_with_email.id != current_user.id):
-                raise HTTPException(
-                    status_code=status.HTTP_409_CONFLICT,
-                    detail='Duplicate email'
-                )
-            current_user.email = new_email
-
+    old_username = current_user.username
+    # current_user may come from the principal cache, attach it
+    # to this session without loading the row again.
+    current_user = await session.merge(current_user, load=False)
+    if data.get('username'):
+        current_user.username = data['username']
+    if data.get('email'):
+        current_user.email = data['email']
     session.add(current_user)
-    session.commit()
-    session.refresh(current_user)
+    await commit_user(session)
+    invalidate_user(old_username)
+    taken_names.add(current_user.username, current_user.email)
     return current_user
+
+
+@router.get("/availability", dependencies=[Depends(availability_ip_limit)])
+async def availability(
+    session: Annotated[AsyncSession, Depends(get_read_session)],
+    username: Annotated[str | None, Query()] = None,
+    email: Annotated[str | None, Query()] = None
+):
+    # A hint for signup forms, register still returns 409 for a value
+    # taken in the meantime.
+    if username is None and email is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Pass a username, an email or both"
+        )
+    result = {}
+    if username is not None:
+        result["username"] = not await taken_names.username_taken(session, username)
+    if email is not None:
+        result["email"] = not await taken_names.email_taken(session, email)
+    return result
+
+
+@router.delete("/users/me", status_code=status.HTTP_204_NO_CONTENT)
+async def delete_user(
+    current_user: Annotated[User, Depends(get_current_user)],
+    session: Annotated[AsyncSession, Depends(get_write_session)]
+):
+    # Every batch runs the same statements. A request that fails halfway
+    # leaves a smaller account behind, which can be deleted again.
+    allow_repeated_queries()
+    while recommendation_ids := await delete_user_recommendations(
+        session=session, user_id=current_user.id, limit=ACCOUNT_DELETE_BATCH_SIZE
+    ):
+        await session.commit()
+        cache_keys = [recommendation_cache_key(recommendation_id)
+                      for recommendation_id in recommendation_ids]
+        await response_cache.delete(*cache_keys)
+        if replica_engine is not None:
+            delete_later(DATABASE_REPLICA_MAX_LAG, *cache_keys)
+    user = User.__table__
+    await session.execute(delete(user).where(user.c.id == current_user.id))
+    await publish_reload(session=session)
+    await session.commit()
+    invalidate_user(current_user.username)
@@ -27,7 +27,7 @@ class RecommendationBase(SQLModel):
 
 
 class TagBase(SQLModel):
-    name: str = Field(max_length=255)
+    name: str = Field(max_length=255, unique=True, index=True)
 
 
 class RecommendationCreate(RecommendationBase):
@@ -38,6 +38,10 @@ class TagRead(TagBase):
     id: int
 
 
+class TagCountRead(TagRead):
+    recommendation_count: int
+
+
 class UserRead(UserBase):
     id: int
 
@@ -50,6 +54,38 @@ class RecommendationRead(RecommendationBase):
     tags: list[TagRead] = []
 
 
+class RecommendationPage(SQLModel):
+    items: list[RecommendationRead]
+    next_cursor: str | None = None
+
+
+class RecommendationSearchPage(SQLModel):
+    items: list[RecommendationRead]
+    next_offset: int | None = None
+
+
+class FacetCount(SQLModel):
+    value: str
+    count: int
+
+
+class Facets(SQLModel):
+    type_of_fiction: list[FacetCount]
+    tags: list[FacetCount]
+
+
+class BulkImportItem(SQLModel):
+    index: int
+    id: int | None = None
+    error: str | None = None
+
+
+class BulkImportResult(SQLModel):
+    created: int
+    failed: int
+    items: list[BulkImportItem]
+
+
 class UserCreate(UserBase):
     password: str = Field(min_length=8)
 
@@ -0,0 +1,94 @@
+import json
+from operator import attrgetter
+from typing import Any, Callable
+
+from decouple import config
+from fastapi import Response, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, ORJSONResponse
+from sqlmodel import SQLModel
+
+from .models import User, Tag, Recommendation
+from .schemas import UserRead, TagRead, RecommendationRead
+
+
+# Responses are rendered with orjson, and ORM objects are turned into dicts
+# by the serializers below instead of being validated against the response
+# model and run through jsonable_encoder first. Needs the orjson package.
+FAST_SERIALIZATION = config("FAST_SERIALIZATION", default=False, cast=bool)
+
+if FAST_SERIALIZATION:
+    try:
+        import orjson
+    except ImportError:
+        raise RuntimeError("The orjson package is required for FAST_SERIALIZATION")
+
+DefaultResponse = ORJSONResponse if FAST_SERIALIZATION else JSONResponse
+
+
+def make_serializer(schema: type[SQLModel],
+                    **nested: Callable[[Any], dict]) -> Callable[[Any], dict]:
+    # Reads the fields of the schema off the object, list fields of other
+    # schemas go through the serializer of that schema. Values are used as
+    # they are, which is only right for objects read from our own database.
+    names = tuple(schema.__fields__)
+    get_values = attrgetter(*names)
+
+    def serialize(obj) -> dict:
+        return dict(zip(names, get_values(obj)))
+
+    if not nested:
+        return serialize
+    nested_fields = tuple(nested.items())
+
+    def serialize_nested(obj) -> dict:
+        data = serialize(obj)
+        for name, serializer in nested_fields:
+            data[name] = list(map(serializer, data[name]))
+        return data
+
+    return serialize_nested
+
+
+tag_read = make_serializer(TagRead)
+recommendation_read = make_serializer(RecommendationRead, tags=tag_read)
+user_read = make_serializer(UserRead)
+
+SERIALIZERS = {Tag: tag_read, Recommendation: recommendation_read, User: user_read}
+
+
+def to_content(value):
+    serializer = SERIALIZERS.get(type(value))
+    if serializer is not None:
+        return serializer(value)
+    if isinstance(value, list):
+        return [to_content(item) for item in value]
+    if isinstance(value, dict):
+        return {key: to_content(item) for key, item in value.items()}
+    return value
+
+
+def fast_response(content, response: Response, status_code: int = status.HTTP_200_OK):
+    # Returned from a route instead of `content`. A Response skips the
+    # response_model, which is then only used for the documentation, and
+    # FastAPI no longer adds the headers of the route's `response`
+    # parameter (cookies set by dependencies), so they are copied here.
+    if not FAST_SERIALIZATION:
+        return content
+    result = ORJSONResponse(to_content(content), status_code=status_code)
+    result.headers.raw.extend(response.headers.raw)
+    return result
+
+
+def serialize_recommendation(recommendation: Recommendation) -> bytes:
+    if FAST_SERIALIZATION:
+        return orjson.dumps(recommendation_read(recommendation))
+    return JSONResponse(
+        content=jsonable_encoder(RecommendationRead.from_orm(recommendation))
+    ).body
+
+
+def serialize_ndjson(rows: list[dict]) -> str | bytes:
+    if FAST_SERIALIZATION:
+        return b"".join(orjson.dumps(row, option=orjson.OPT_APPEND_NEWLINE) for row in rows)
+    return "".join(json.dumps(jsonable_encoder(row)) + "\n" for row in rows)
@@ -0,0 +1,335 @@
+"""In-process benchmarks for every endpoint.
+
+The app is driven through httpx' ASGI transport against a throwaway SQLite
+database (or any DATABASE_URL given with --database-url), migrated with
+Alembic and seeded before the run:
+
+    python -m benchmarks.run --requests 500 --concurrency 20
+    python -m benchmarks.run --save-baseline benchmarks/baselines/local.json
+    python -m benchmarks.run --baseline benchmarks/baselines/local.json
+
+A run against a baseline fails (exit code 1) when a scenario falls outside
+the limits in benchmarks/thresholds.json.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+
+ROOT = Path(__file__).resolve().parent.parent
+DEFAULT_THRESHOLDS = Path(__file__).resolve().parent / "thresholds.json"
+PASSWORD = "benchmark-password"
+SCENARIOS = ["register", "token", "users_me", "post_recommendation",
+             "get_recommendation", "list_recommendations", "delete_recommendation"]
+QUERIES_PATTERN = re.compile(r'desc="(\d+) queries"')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--database-url",
+                        help="database to benchmark against, a temporary SQLite file by default")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--recommendations-per-user", type=int, default=20)
+    parser.add_argument("--tags", type=int, default=500)
+    parser.add_argument("--requests", type=int, default=300,
+                        help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--bcrypt-rounds", type=int,
+                        help="overrides BCRYPT_ROUNDS for the run")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", type=Path, help="write the results as JSON")
+    parser.add_argument("--save-baseline", type=Path, help="write the results as a baseline")
+    parser.add_argument("--baseline", type=Path, help="compare the results with a baseline")
+    parser.add_argument("--thresholds", type=Path, default=DEFAULT_THRESHOLDS)
+    return parser.parse_args(argv)
+
+
+def configure_environment(args, directory: str) -> str:
+    # Settings are read when the app modules are imported, so the
+    # environment has to be in place before that.
+    if args.database_url:
+        database_url = args.database_url
+    else:
+        database_url = f"sqlite:///{directory}/benchmark.db"
+    os.environ["DATABASE_URL"] = database_url
+    os.environ.setdefault("SECRET_KEY", "benchmark-secret")
+    # Every request comes from the same address, the limits would measure
+    # themselves instead of the endpoints.
+    for name in ("TOKEN_RATE_LIMIT_PER_IP", "TOKEN_RATE_LIMIT_PER_USERNAME",
+                 "REGISTER_RATE_LIMIT_PER_IP", "TOKEN_CONCURRENCY_LIMIT",
+                 "REGISTER_CONCURRENCY_LIMIT"):
+        os.environ.setdefault(name, "0")
+    if args.bcrypt_rounds:
+        os.environ["BCRYPT_ROUNDS"] = str(args.bcrypt_rounds)
+    return database_url
+
+
+def migrate():
+    from alembic import command
+    from alembic.config import Config
+
+    config = Config(str(ROOT / "alembic.ini"))
+    config.set_main_option("script_location", str(ROOT / "alembic"))
+    command.upgrade(config, "head")
+
+
+def seed(args, rng: random.Random) -> dict:
+    from sqlalchemy import insert
+    from app.commands.rebuild_facets import rebuild_facets
+    from app.commands.reconcile_tag_counts import reconcile_tag_counts
+    from app.database import engine
+    from app.hashing import pwd_context
+    from app.models import User, Tag, Recommendation, RecommendationTagLink
+
+    hashed_password = pwd_context.hash(PASSWORD)
+    users = [{"id": id, "username": f"benchmark-user-{id}",
+              "email": f"benchmark-{id}@example.com",
+              "hashed_password": hashed_password}
+             for id in range(1, args.users + 1)]
+    tags = [{"id": id, "name": f"tag-{id}"} for id in range(1, args.tags + 1)]
+    recommendations = []
+    links = []
+    for user in users:
+        for _ in range(args.recommendations_per_user):
+            id = len(recommendations) + 1
+            recommendations.append({
+                "id": id, "user_id": user["id"],
+                "type_of_fiction": rng.choice(["fantasy", "science-fiction", "horror", "mystery"]),
+                "title": f"Recommendation {id}",
+                "short_description": "A short description of the book.",
+                "opinion": "An opinion that is a few sentences long.",
+            })
+            for tag_id in rng.sample(range(1, args.tags + 1), k=min(3, args.tags)):
+                links.append({"recommendation_id": id, "tag_id": tag_id})
+    with engine.begin() as connection:
+        connection.execute(insert(User), users)
+        connection.execute(insert(Tag), tags)
+        if recommendations:
+            connection.execute(insert(Recommendation), recommendations)
+            connection.execute(insert(RecommendationTagLink), links)
+        # The API keeps these up to date, the rows above bypass it.
+        reconcile_tag_counts(connection)
+        rebuild_facets(connection)
+    return {"users": users, "tags": tags, "recommendations": recommendations}
+
+
+class Scenario:
+    def __init__(self, name: str, request):
+        self.name = name
+        self.request = request
+
+
+def build_scenarios(data: dict, args, rng: random.Random) -> dict[str, Scenario]:
+    from datetime import timedelta
+    from app.auth import create_access_token
+
+    users = data["users"]
+    tokens = {user["id"]: create_access_token({"sub": user["username"]},
+                                              expires_delta=timedelta(hours=1))
+              for user in users}
+    recommendations = data["recommendations"]
+    # Every delete removes a different recommendation, with its owner's token.
+    deletable = rng.sample(recommendations, k=min(args.requests, len(recommendations)))
+    deletable_ids = {r["id"] for r in deletable}
+    readable = [r["id"] for r in recommendations if r["id"] not in deletable_ids] or [1]
+    run_id = rng.randrange(10 ** 9)
+
+    def auth(user_id):
+        return {"Authorization": f"Bearer {tokens[user_id]}"}
+
+    async def register(client, i):
+        return await client.post("/auth/register", json={
+            "username": f"new-user-{run_id}-{i}",
+            "email": f"new-{run_id}-{i}@example.com",
+            "password": PASSWORD,
+        })
+
+    async def token(client, i):
+        user = users[i % len(users)]
+        return await client.post("/auth/token", data={"username": user["username"],
+                                                      "password": PASSWORD})
+
+    async def users_me(client, i):
+        return await client.get("/auth/users/me", headers=auth(users[i % len(users)]["id"]))
+
+    async def post_recommendation(client, i):
+        user = users[i % len(users)]
+        return await client.post("/recommend", headers=auth(user["id"]), json={
+            "type_of_fiction": "fantasy",
+            "title": f"Benchmark {i}",
+            "short_description": "Posted by the benchmark.",
+            "opinion": "Fine.",
+            "tags": [f"tag-{rng.randint(1, args.tags)}" for _ in range(3)] + [f"fresh-{run_id}-{i}"],
+        })
+
+    async def get_recommendation(client, i):
+        return await client.get(f"/recommendations/{readable[i % len(readable)]}")
+
+    async def list_recommendations(client, i):
+        # The largest page, where serialization weighs the most.
+        return await client.get("/recommendations", params={"limit": 100})
+
+    async def delete_recommendation(client, i):
+        recommendation = deletable[i % len(deletable)]
+        return await client.delete(f"/recommendations/{recommendation['id']}",
+                                   headers=auth(recommendation["user_id"]))
+
+    return {name: Scenario(name, request) for name, request in [
+        ("register", register), ("token", token), ("users_me", users_me),
+        ("post_recommendation", post_recommendation),
+        ("get_recommendation", get_recommendation),
+        ("list_recommendations", list_recommendations),
+        ("delete_recommendation", delete_recommendation),
+    ]}
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    index = min(int(round(q / 100 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+async def run_scenario(client, scenario: Scenario, requests: int, concurrency: int) -> dict:
+    latencies = []
+    queries = []
+    errors = 0
+    counter = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            start = time.perf_counter()
+            response = await scenario.request(client, i)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+            match = QUERIES_PATTERN.search(response.headers.get("server-timing", ""))
+            if match:
+                queries.append(int(match.group(1)))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return {
+        "requests": requests,
+        "errors": errors,
+        "throughput_rps": requests / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "queries_per_request": statistics.fmean(queries) if queries else None,
+    }
+
+
+async def run(args) -> dict:
+    import httpx
+    from app.database import dispose_engines
+    from app.main import app
+
+    rng = random.Random(args.seed)
+    data = seed(args, rng)
+    scenarios = build_scenarios(data, args, rng)
+    results = {}
+    await app.router.startup()
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app),
+                                     base_url="http://benchmark") as client:
+            for name in args.scenarios:
+                results[name] = await run_scenario(client, scenarios[name],
+                                                   args.requests, args.concurrency)
+    finally:
+        await app.router.shutdown()
+        await dispose_engines()
+    return results
+
+
+def compare(results: dict, baseline: dict, thresholds: dict) -> list[str]:
+    failures = []
+    for name, result in results.items():
+        limits = {**thresholds.get("default", {}), **thresholds.get(name, {})}
+        base = baseline.get("scenarios", {}).get(name)
+        if result["errors"] > limits.get("max_errors", 0):
+            failures.append(f"{name}: {result['errors']} failed requests")
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            if f"max_{key}" in limits and result[key] > limits[f"max_{key}"]:
+                failures.append(f"{name}: {key} {result[key]:.1f} above {limits[f'max_{key}']}")
+        if base is None:
+            continue
+        latency_limit = limits.get("max_latency_regression")
+        if latency_limit is not None:
+            for key in ("p50_ms", "p95_ms", "p99_ms"):
+                if result[key] > base[key] * (1 + latency_limit):
+                    failures.append(f"{name}: {key} {result[key]:.1f} vs baseline {base[key]:.1f}")
+        throughput_limit = limits.get("max_throughput_regression")
+        if (throughput_limit is not None
+                and result["throughput_rps"] < base["throughput_rps"] * (1 - throughput_limit)):
+            failures.append(f"{name}: throughput {result['throughput_rps']:.0f}/s "
+                            f"vs baseline {base['throughput_rps']:.0f}/s")
+        queries_limit = limits.get("max_queries_increase")
+        if (queries_limit is not None and result["queries_per_request"] is not None
+                and base.get("queries_per_request") is not None
+                and result["queries_per_request"] > base["queries_per_request"] + queries_limit):
+            failures.append(f"{name}: {result['queries_per_request']:.2f} queries per request "
+                            f"vs baseline {base['queries_per_request']:.2f}")
+    return failures
+
+
+def print_results(results: dict):
+    print(f"{'scenario':<24}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+          f"{'queries':>10}{'errors':>8}")
+    for name, result in results.items():
+        queries = result["queries_per_request"]
+        print(f"{name:<24}{result['throughput_rps']:>10.1f}{result['p50_ms']:>10.2f}"
+              f"{result['p95_ms']:>10.2f}{result['p99_ms']:>10.2f}"
+              f"{queries if queries is None else round(queries, 2):>10}{result['errors']:>8}")
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    sys.path.insert(0, str(ROOT))
+    directory = tempfile.mkdtemp(prefix="benchmark-")
+    try:
+        database_url = configure_environment(args, directory)
+        migrate()
+        results = asyncio.run(run(args))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    print_results(results)
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "database": database_url.split(":", 1)[0],
+        "parameters": {key: getattr(args, key) for key in
+                       ("users", "recommendations_per_user", "tags", "requests",
+                        "concurrency", "bcrypt_rounds", "seed")},
+        "scenarios": results,
+    }
+    for path in (args.output, args.save_baseline):
+        if path:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(json.dumps(report, indent=2) + "\n")
+
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text())
+        thresholds = json.loads(args.thresholds.read_text())
+        failures = compare(results, baseline, thresholds)
+        for failure in failures:
+            print(f"FAIL {failure}")
+        if failures:
+            return 1
+        print(f"All scenarios within thresholds of {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,101 @@
+"""Serialization benchmark, default path against FAST_SERIALIZATION.
+
+    python -m benchmarks.serialization --sizes 100 1000
+
+Lists of recommendations are built in memory and turned into response
+bodies the way a route does it: validated against the response model,
+run through jsonable_encoder and dumped with json, or converted by the
+serializers of app.serialization and dumped with orjson. No database is
+involved, the end to end difference shows in the list_recommendations
+scenario of
+
+    FAST_SERIALIZATION=1 python -m benchmarks.run --scenarios list_recommendations
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000],
+                        help="recommendations per payload")
+    parser.add_argument("--tags", type=int, default=3, help="tags per recommendation")
+    parser.add_argument("--seconds", type=float, default=2,
+                        help="time spent on each path and size")
+    return parser.parse_args(argv)
+
+
+def build_recommendations(count: int, tags_per_recommendation: int) -> list:
+    from app.models import Recommendation, Tag
+
+    tags = [Tag(id=id, name=f"tag-{id}") for id in range(1, 51)]
+    published = datetime(2023, 1, 1)
+    return [Recommendation(id=id, user_id=id % 100 + 1,
+                           type_of_fiction="fantasy",
+                           title=f"Recommendation {id}",
+                           short_description="A short description of the book.",
+                           opinion="An opinion that is a few sentences long. " * 5,
+                           published=published + timedelta(minutes=id),
+                           tags=[tags[(id + offset) % len(tags)]
+                                 for offset in range(tags_per_recommendation)])
+            for id in range(1, count + 1)]
+
+
+def default_body(recommendations: list) -> bytes:
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse
+    from pydantic import parse_obj_as
+    from app.schemas import RecommendationRead
+
+    validated = parse_obj_as(list[RecommendationRead], recommendations)
+    return JSONResponse(content=jsonable_encoder(validated)).body
+
+
+def fast_body(recommendations: list) -> bytes:
+    from fastapi.responses import ORJSONResponse
+    from app.serialization import to_content
+
+    return ORJSONResponse(to_content(recommendations)).body
+
+
+def measure(serialize, recommendations: list, seconds: float) -> float:
+    serialize(recommendations)
+    runs = 0
+    start = time.perf_counter()
+    while (elapsed := time.perf_counter() - start) < seconds:
+        serialize(recommendations)
+        runs += 1
+    return runs / elapsed
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    sys.path.insert(0, str(ROOT))
+    # Only needed for the app modules to import.
+    os.environ.setdefault("DATABASE_URL", "sqlite://")
+    os.environ.setdefault("SECRET_KEY", "benchmark-secret")
+
+    print(f"{'items':>8}{'default/s':>12}{'fast/s':>12}{'speedup':>10}"
+          f"{'default ms':>12}{'fast ms':>10}")
+    for size in args.sizes:
+        recommendations = build_recommendations(size, args.tags)
+        if default_body(recommendations) != fast_body(recommendations):
+            print(f"{size}: the two paths produce different bodies")
+            return 1
+        default_rate = measure(default_body, recommendations, args.seconds)
+        fast_rate = measure(fast_body, recommendations, args.seconds)
+        print(f"{size:>8}{default_rate:>12.1f}{fast_rate:>12.1f}"
+              f"{fast_rate / default_rate:>9.1f}x"
+              f"{1000 / default_rate:>12.2f}{1000 / fast_rate:>10.2f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())